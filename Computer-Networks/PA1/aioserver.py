@@ -0,0 +1,128 @@
+import asyncio
+import signal
+import time
+
+from common import framing
+from common import prefork
+from PA1 import service
+
+# asyncio engine of the PA1 server, in its own module so that the blocking engine (and
+# everything else importing PA1.server) starts without loading asyncio.
+
+class PacketProtocol(asyncio.BufferedProtocol):
+    # asyncio engine connection: received bytes land directly in the connection's FrameBuffer
+    def __init__(self, header_format, quiet=False, limiter=None, sessions=None, max_payload=None, connections=None):
+        self.buffer = framing.FrameBuffer(framing.get_layout(header_format), max_payload=max_payload)
+        self.response = service.create_response()
+        self.quiet = quiet
+        self.limiter = limiter
+        self.sessions = sessions
+        self.connections = connections # open connections of the server, for a graceful stop
+        self.transport = None
+        self.peer = None
+        self.admitted = False
+        self.write_paused = False
+        self.throttled = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        if self.sessions is not None and not self.sessions.open():
+            service.REJECTED_CONNECTIONS.inc()
+            transport.abort()
+            return
+        self.admitted = True
+        if self.connections is not None:
+            self.connections.add(self)
+        service.CONNECTIONS.inc()
+        if not self.quiet:
+            print(f"Connected by: {self.peer}")
+
+    def get_buffer(self, sizehint):
+        return self.buffer.get_buffer(max(self.buffer.needed(), 1))
+
+    def buffer_updated(self, nbytes):
+        started = time.perf_counter()
+        self.buffer.commit(nbytes)
+        # Answer every frame parsed out of this read with one write
+        replies = 0
+        try:
+            for frame in self.buffer.frames():
+                try:
+                    payload_string = service.unpack_frame(frame)
+                except ValueError as e:
+                    print('ValueError:', e)
+                    continue
+                if not self.quiet:
+                    print(payload_string)
+                replies += 1
+        except framing.FrameTooLarge as e:
+            service.OVERSIZED_FRAMES.inc()
+            print('Closing connection:', e)
+            self.transport.abort()
+            return
+        if replies:
+            self.transport.writelines([self.response] * replies)
+            service.PACKETS_OUT.inc(replies)
+            service.BYTES_OUT.inc(len(self.response) * replies)
+        service.HANDLE_SECONDS.observe(time.perf_counter() - started)
+
+        # Over the rate limit: stop reading until the peer's bucket has refilled
+        delay = self.limiter.delay(self.peer[0], replies) if self.limiter and replies else 0
+        if delay and not self.throttled:
+            service.THROTTLED.inc()
+            self.throttled = True
+            self.transport.pause_reading()
+            asyncio.get_running_loop().call_later(delay, self.end_throttle)
+
+    def end_throttle(self):
+        self.throttled = False
+        if not self.write_paused and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    # Stop reading from a client that is not reading its replies
+    def pause_writing(self):
+        self.write_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.write_paused = False
+        if not self.throttled:
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        if not self.quiet:
+            print('No Payload has been received')
+        return False
+
+    def connection_lost(self, exc):
+        if self.connections is not None:
+            self.connections.discard(self)
+        if self.admitted and self.sessions is not None:
+            self.sessions.close()
+        if exc is not None:
+            print("Connection closed or an error occurred")
+
+async def serve_asyncio(host, port, header_format, quiet=False, backlog=1024, reuse_port=False,
+                        limiter=None, sessions=None, max_payload=None, grace=None):
+    # asyncio engine: every connection is served concurrently on a single thread
+    loop = asyncio.get_running_loop()
+    connections = set()
+    listener = await loop.create_server(lambda: PacketProtocol(header_format, quiet, limiter, sessions, max_payload, connections),
+                                        host, port, backlog=backlog, reuse_address=True, reuse_port=reuse_port)
+    async with listener:
+        if grace is None:
+            await listener.serve_forever()
+        # Worker mode: on SIGTERM/SIGINT stop accepting, give open connections up to grace
+        # seconds to finish, then leave the way every other worker does
+        stopping = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stopping.set)
+        await stopping.wait()
+        listener.close()
+        deadline = loop.time() + grace
+        while connections and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for protocol in list(connections):
+            protocol.transport.abort()
+    raise prefork.Shutdown('SIGTERM')
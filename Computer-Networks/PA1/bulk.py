@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PA1 import codec
+
+# NumPy is only needed for the bulk paths, the rest of PA1 runs without it. It is imported
+# by require_numpy() on first use, importing this module does not load it.
+np = None
+
+# Service types 1 (int) and 2 (float) have a 4 byte payload, so their frames are all
+# FRAME_SIZE bytes long and a whole buffer of them can be viewed as one structured array.
+FIXED_TYPES = (1, 2)
+PAYLOAD_SIZE = 4
+FRAME_SIZE = codec.HEADER.size + PAYLOAD_SIZE
+
+# header fields as laid out by struct 'BBBH' (native byte order, one pad byte before the H),
+# the payload is exposed both as big endian uint32 and as float32 over the same 4 bytes
+FRAME_FIELDS = {
+    'names': ['version', 'header_length', 'service_type', 'payload_length', 'int_payload', 'float_payload'],
+    'formats': ['u1', 'u1', 'u1', '=u2', '>u4', '>f4'],
+    'offsets': [0, 1, 2, codec.HEADER.size - 2, codec.HEADER.size, codec.HEADER.size],
+    'itemsize': FRAME_SIZE,
+}
+HEADER_FIELDS = {
+    'names': ['version', 'header_length', 'service_type', 'payload_length'],
+    'formats': ['u1', 'u1', 'u1', '=u2'],
+}
+
+def require_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError('NumPy is required for bulk encoding/decoding (pip install numpy)') from None
+    return np
+
+def frame_dtype():
+    require_numpy()
+    return np.dtype(FRAME_FIELDS)
+
+# True if buf is nothing but back-to-back type 1/2 frames
+def is_fixed(frames):
+    return bool(((frames['payload_length'] == PAYLOAD_SIZE) & np.isin(frames['service_type'], FIXED_TYPES)).all())
+
+# payload values of fixed frames: uint32 or float32 when the buffer holds one type, float64 when mixed
+def fixed_values(frames):
+    service_types = frames['service_type']
+    if (service_types == 1).all():
+        return frames['int_payload'].astype(np.uint32)
+    if (service_types == 2).all():
+        return frames['float_payload'].astype(np.float32)
+    return np.where(service_types == 1, frames['int_payload'], frames['float_payload'].astype(np.float64))
+
+# one packet at a time, works for every service type (variable length strings included)
+def iter_frames(buf):
+    view = memoryview(buf)
+    offset = 0
+    while offset < len(view):
+        header, value, consumed = codec.unpack_from(view, offset)
+        offset += consumed
+        yield header, value
+
+# decode a buffer of packets into (headers, values) arrays.
+# Buffers made only of type 1/2 frames are decoded with a single structured view, anything
+# else (type 3 strings, 8 byte types) falls back to the streaming loop.
+def decode_frames(buf):
+    require_numpy()
+    if len(buf) % FRAME_SIZE == 0:
+        frames = np.frombuffer(buf, dtype=frame_dtype())
+        if is_fixed(frames):
+            return frames[HEADER_FIELDS['names']], fixed_values(frames)
+
+    headers = []
+    values = []
+    for header, value in iter_frames(buf):
+        headers.append(header)
+        values.append(value)
+    result = np.empty(len(values), dtype=object)
+    result[:] = values
+    return np.array(headers, dtype=np.dtype(HEADER_FIELDS)), result
+
+# encode many packets into one contiguous bytes object
+def encode_frames(service_types, values, version=1, header_length=4):
+    require_numpy()
+    service_types = np.asarray(service_types, dtype=np.uint8)
+    if service_types.ndim == 0:
+        service_types = np.full(len(values), service_types, dtype=np.uint8)
+
+    if np.isin(service_types, FIXED_TYPES).all():
+        frames = np.zeros(len(service_types), dtype=frame_dtype())
+        frames['version'] = version
+        frames['header_length'] = header_length
+        frames['service_type'] = service_types
+        frames['payload_length'] = PAYLOAD_SIZE
+        # the two payload fields overlap, so write ints first and floats over their rows
+        values = np.asarray(values)
+        ints = service_types == 1
+        frames['int_payload'][ints] = values[ints].astype(np.uint32)
+        frames['float_payload'][~ints] = values[~ints].astype(np.float32)
+        return frames.tobytes()
+
+    return b''.join(codec.encode(version, header_length, int(service_type), value)
+                    for service_type, value in zip(service_types, values))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Bulk generation and decoding of PA1 packets.")
+    parser.add_argument('--generate', type=int, help='Number of packets to generate')
+    parser.add_argument('--service_type', type=int, choices=FIXED_TYPES, default=1, help='Service type of the generated packets (1 for int, 2 for float)')
+    parser.add_argument('--output', type=str, help='File to write generated packets to')
+    parser.add_argument('--decode', type=str, help='File of back-to-back packets to decode')
+
+    args = parser.parse_args()
+    require_numpy()
+
+    if args.generate:
+        start = time.perf_counter()
+        data = encode_frames(args.service_type, np.arange(args.generate) % 1000)
+        elapsed = time.perf_counter() - start
+        print(f"Encoded {args.generate} packets ({len(data)} bytes) in {elapsed:.3f}s")
+        if args.output:
+            with open(args.output, 'wb') as f:
+                f.write(data)
+
+    if args.decode:
+        with open(args.decode, 'rb') as f:
+            data = f.read()
+        start = time.perf_counter()
+        headers, values = decode_frames(data)
+        elapsed = time.perf_counter() - start
+        print(f"Decoded {len(headers)} packets in {elapsed:.3f}s")
+        for service_type in np.unique(headers['service_type']):
+            print(f"Service Type {service_type}: {int((headers['service_type'] == service_type).sum())} packets")
@@ -1,35 +1,101 @@
-import argparse
+import collections
+import itertools
+import os
+import selectors
 import socket
-import struct
+import sys
+import time
+
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import framing
+from PA1 import codec
 
 def create_packet(version, header_length, service_type, payload):
-    # Checking service type for proper payload encoding
-    if service_type == 1:
-        payload_data = struct.pack('!I', int(payload))
-    elif service_type == 2:
-        payload_data = struct.pack('!f', float(payload))
-    elif service_type == 3:
-        payload_data = payload.encode('utf-8')
-    else:
-        raise ValueError('Incorrect Value Type')
-    
-    # Creating header
-    header_format = 'BBBH'
-    payload_length = len(payload_data)
-    header_data = struct.pack(header_format, version, header_length, service_type, payload_length)
-    # Attaching payload
-    packet = header_data + payload_data
+    # Payload encoding comes from the codec registered for the service type
+    return codec.encode(version, header_length, service_type, payload)
+
+def decode_response(frame):
+    header, payload_data = frame
+    return header, codec.decode(header[2], payload_data)
+
+# seconds without any progress (nothing read, nothing written) before giving up on the server
+TIMEOUT = 5.0
 
-    return packet
+# write as many queued frames as the socket takes without blocking; a partly written frame is
+# replaced by its unsent tail
+def write_some(sock, queued):
+    try:
+        sent = sock.sendmsg(list(itertools.islice(queued, framing.IOV_MAX)))
+    except BlockingIOError:
+        return
+    while sent:
+        frame = queued[0]
+        if sent < len(frame):
+            queued[0] = memoryview(frame)[sent:]
+            return
+        sent -= len(frame)
+        queued.popleft()
+
+def send_pipelined(sock, reader, packets, depth, timeout=TIMEOUT):
+    # Keep up to depth packets in flight. The server answers in order, so replies match the
+    # oldest outstanding packet. The socket is non-blocking and writes are interleaved with
+    # reads: a window larger than the socket buffers would otherwise leave both sides blocked
+    # in send() with nobody reading.
+    responses = []
+    sent = 0
+    queued = collections.deque() # frames of the window not yet written
+    buffer = reader.buffer
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    events = selectors.EVENT_READ
+    sock.setblocking(False)
+    try:
+        while len(responses) < len(packets):
+            if sent < len(packets) and sent - len(responses) < depth:
+                batch = packets[sent:len(responses) + depth]
+                queued.extend(batch)
+                sent += len(batch)
+            if queued:
+                write_some(sock, queued)
+            wanted = selectors.EVENT_READ | (selectors.EVENT_WRITE if queued else 0)
+            if wanted != events:
+                selector.modify(sock, wanted)
+                events = wanted
+
+            ready = selector.select(timeout)
+            if not ready:
+                raise TimeoutError(f'No progress for {timeout}s, {len(responses)} of {sent} packets answered')
+            if not ready[0][1] & selectors.EVENT_READ:
+                continue
+            try:
+                nbytes = sock.recv_into(buffer.get_buffer(max(buffer.needed(), 1)))
+            except BlockingIOError:
+                continue
+            if nbytes == 0:
+                raise ConnectionError('Server closed the connection')
+            buffer.commit(nbytes)
+            for frame in buffer.frames():
+                responses.append(decode_response(frame))
+    finally:
+        selector.close()
+        sock.setblocking(True)
+    return responses
 
 if __name__ == '__main__':
+    import argparse
+
     parser = argparse.ArgumentParser(description="Client for packet creation and sending.")
     parser.add_argument('--version', type=int, required=True, help='Packet version')
     parser.add_argument('--header_length', type=int, required=True, help='Length of the packet header')
-    parser.add_argument('--service_type', type=int, required=True, help='Service type of the payload (1 for int, 2 for float, 3 for string)')
+    parser.add_argument('--service_type', type=int, required=True, help='Service type of the payload (1 for int, 2 for float, 3 for string, 4 for int64, 5 for double, 6 for raw bytes as hex)')
     parser.add_argument('--payload', type=str, required=True, help='Payload to be packed into the packet')
     parser.add_argument('--host', type=str, default='localhost', help='Server host')
     parser.add_argument('--port', type=int, default=12345, help='Server port')
+    parser.add_argument('--count', type=int, default=1, help='Number of packets to send')
+    parser.add_argument('--pipeline', type=int, default=1, help='Packets kept in flight before waiting for replies (1 = one round trip per packet)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='Seconds to wait for the server before giving up')
 
     args = parser.parse_args()
 
@@ -39,33 +105,17 @@ if __name__ == '__main__':
     # Connect to the server
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.connect((args.host, args.port))
+        reader = framing.FrameReader(s, framing.BBBH)
 
-        while True:
-            # Send the packet
-            s.send(packet)
-            
-            # Receive the packet
-            response = s.recv(1024)
+        start = time.perf_counter()
+        responses = send_pipelined(s, reader, [packet] * args.count, max(args.pipeline, 1), args.timeout)
+        elapsed = time.perf_counter() - start
 
-            header_format = 'BBBH'
-            header_size = struct.calcsize(header_format)
-            header_data = response[:header_size]
-            payload_data = response[header_size:]
+        if args.count == 1:
+            (version, header_length, service_type, payload_length), payload = responses[0]
 
-            version, header_length, service_type, payload_length = struct.unpack(header_format, header_data)
-            
             # Print header
             print(f"Received Header - Version: {version}, Header Length: {header_length}, Service Type: {service_type}, Payload Length: {payload_length}")
-            
-            # Checking service type for proper payload decoding and printing payload
-            if service_type == 1:
-                payload = struct.unpack('!I', payload_data)[0]
-            elif service_type == 2:
-                payload = struct.unpack('!f', payload_data)[0]
-            elif service_type == 3:
-                payload = payload_data.decode('utf-8')
-            else:
-                raise ValueError('Incorrect Value Type')
-
             print(f"Received Payload: {payload}")
-            break
\ No newline at end of file
+        else:
+            print(f"Received {len(responses)} responses in {elapsed:.3f}s ({len(responses) / elapsed:.0f} packets/s, pipeline depth {args.pipeline})")
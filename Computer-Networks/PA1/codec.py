@@ -0,0 +1,101 @@
+import struct
+
+from common import framing
+
+# Fixed length header -> Version (1 byte), Header Length (1 byte), Service Type (1 byte), Payload Length (2 bytes)
+HEADER = framing.BBBH.header
+
+# Payload codecs. Every codec can encode() to bytes, or pack_into()/unpack_from() a caller
+# supplied buffer. Fixed size payloads use a struct.Struct compiled once at import.
+
+class StructCodec:
+    def __init__(self, payload_format, convert):
+        self.struct = struct.Struct(payload_format)
+        self.convert = convert
+
+    def encode(self, value):
+        return self.struct.pack(self.convert(value))
+
+    def pack_into(self, buf, offset, value):
+        self.struct.pack_into(buf, offset, self.convert(value))
+        return self.struct.size
+
+    def unpack_from(self, buf, offset, length):
+        if length != self.struct.size:
+            raise ValueError(f'Payload length {length} does not match {self.struct.format}')
+        return self.struct.unpack_from(buf, offset)[0]
+
+class StringCodec:
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+
+    def encode(self, value):
+        return value.encode(self.encoding)
+
+    def pack_into(self, buf, offset, value):
+        data = value.encode(self.encoding)
+        memoryview(buf)[offset:offset + len(data)] = data
+        return len(data)
+
+    def unpack_from(self, buf, offset, length):
+        return str(memoryview(buf)[offset:offset + length], self.encoding)
+
+# raw bytes payload, strings are taken as hex (command line payloads)
+class BytesCodec:
+    def encode(self, value):
+        if isinstance(value, str):
+            return bytes.fromhex(value)
+        return bytes(value)
+
+    def pack_into(self, buf, offset, value):
+        data = self.encode(value)
+        memoryview(buf)[offset:offset + len(data)] = data
+        return len(data)
+
+    def unpack_from(self, buf, offset, length):
+        return bytes(memoryview(buf)[offset:offset + length])
+
+# service type -> payload codec
+CODECS = {}
+
+def register(service_type, codec):
+    if not 0 <= service_type <= 255:
+        raise ValueError(f'Service type must fit in one byte: {service_type}')
+    CODECS[service_type] = codec
+
+def get_codec(service_type):
+    try:
+        return CODECS[service_type]
+    except KeyError:
+        raise ValueError('Incorrect Service Type')
+
+register(1, StructCodec('!I', int))
+register(2, StructCodec('!f', float))
+register(3, StringCodec('utf-8'))
+register(4, StructCodec('!q', int))
+register(5, StructCodec('!d', float))
+register(6, BytesCodec())
+
+# whole packet as bytes
+def encode(version, header_length, service_type, value):
+    payload_data = get_codec(service_type).encode(value)
+    return HEADER.pack(version, header_length, service_type, len(payload_data)) + payload_data
+
+# payload value out of received payload bytes
+def decode(service_type, payload_data):
+    return get_codec(service_type).unpack_from(payload_data, 0, len(payload_data))
+
+# write a whole packet into buf at offset, returns the number of bytes written
+def pack_into(buf, offset, version, header_length, service_type, value):
+    payload_length = get_codec(service_type).pack_into(buf, offset + HEADER.size, value)
+    HEADER.pack_into(buf, offset, version, header_length, service_type, payload_length)
+    return HEADER.size + payload_length
+
+# read one packet from buf at offset, returns (header tuple, value, bytes consumed)
+def unpack_from(buf, offset=0):
+    header = HEADER.unpack_from(buf, offset)
+    service_type, payload_length = header[2], header[3]
+    if len(buf) - offset < HEADER.size + payload_length:
+        raise ValueError('Incomplete packet')
+    value = get_codec(service_type).unpack_from(buf, offset + HEADER.size, payload_length)
+    return header, value, HEADER.size + payload_length
@@ -1,72 +1,162 @@
-import socket
-import struct
+import os
+import sys
+import time
 
-def unpack_packet(conn, header_format):
-    # Receiving header data
-    header_data = conn.recv(struct.calcsize(header_format))
-    if not header_data:
-        return None
-    # Unpacking header information
-    version, header_length, service_type, payload_length = struct.unpack(header_format, header_data)
-    # Recieving Payload
-    payload_data = conn.recv(payload_length)
-    if not payload_data:
-        return None
-    # Checking service type for proper payload unpacking
-    if service_type == 1:
-        payload = struct.unpack('!I', payload_data)[0]
-    elif service_type == 2:
-        payload = struct.unpack('!f', payload_data)[0]
-    elif service_type == 3:
-        payload = payload_data.decode('utf-8')
-    else:
-        raise ValueError('Incorrect Service Type')
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import admission
+from common import framing
+from common import metrics
+from common import prefork
+from PA1.service import (BYTES_OUT, CONNECTIONS, HANDLE_SECONDS, OVERSIZED_FRAMES, PACKETS_OUT, THROTTLED,
+                         create_response, unpack_frame)
 
-    # Return header string
-    packet_header_as_string = (f"Version: {version}, Header Length: {header_length}, Service Type: {service_type}, Payload_length: {payload_length}\nPayload: {payload}")
-    return packet_header_as_string
+# Fixed length header -> Version (1 byte), Header Length (1 byte), Service Type (1 byte), Payload Length (2 bytes)
+HEADER_FORMAT = 'BBBH'
 
-if __name__ == '__main__':
-    host = 'localhost'
-    port = 12345
+def unpack_packet(reader):
+    # Receiving a whole frame (header and payload) from the connection's frame reader
+    frame = reader.read_frame()
+    if frame is None:
+        return None
+    return unpack_frame(frame)
 
-    # Fixed length header -> Version (1 byte), Header Length (1 byte), Service Type (1 byte), Payload Length (2 bytes)
-    header_format = 'BBBH'
+def unpack_buffered(reader):
+    # Frames that arrived in the same read as the last one, so they can be answered together
+    payload_strings = []
+    for frame in reader.buffered_frames():
+        try:
+            payload_strings.append(unpack_frame(frame))
+        except ValueError as e:
+            print('ValueError:', e)
+    return payload_strings
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((host, port))
-        s.listen()
+def serve_blocking(host, port, header_format, quiet=False, reuse_port=False, limiter=None, max_payload=None, grace=None):
+    # Original engine: one connection at a time on a blocking accept() loop
+    response = create_response()
+    with prefork.listen_socket(host, port, reuse_port=reuse_port) as s:
         while True: # Keep server running
             conn, addr = s.accept()
+            stopping = None # set when the worker is asked to stop
             with conn:
+                CONNECTIONS.inc()
                 print(f"Connected by: {addr}")
+                reader = framing.FrameReader(conn, framing.get_layout(header_format), max_payload=max_payload)
                 while True:
+                    if stopping is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        conn.settimeout(remaining)
                     try:
                         # Receive/unpack packet using the unpack_packet function
-                        payload_string = unpack_packet(conn, header_format)
+                        payload_string = unpack_packet(reader)
                         if payload_string is None:
                             print('No Payload has been received')
                             break
-                        else:
-                            print(payload_string)
+                        started = time.perf_counter()
+                        # Pipelined clients: everything else that came in with this read is handled now too
+                        payload_strings = [payload_string] + unpack_buffered(reader)
+                        if not quiet:
+                            for payload_string in payload_strings:
+                                print(payload_string)
 
-                        # Creating header
-                        version = 1
-                        header_length = 4
-                        service_type = 3
-                        payload = 'Message Recieved'
-                        payload_length = len(payload)
+                        # Send to client, one vectored write for the whole batch
+                        framing.send_frames(conn, [response] * len(payload_strings))
+                        PACKETS_OUT.inc(len(payload_strings))
+                        BYTES_OUT.inc(len(response) * len(payload_strings))
+                        HANDLE_SECONDS.observe(time.perf_counter() - started)
 
-                        header_data = struct.pack(header_format, version, header_length, service_type, payload_length)
+                        # Over the rate limit: stop reading, TCP flow control slows the client down
+                        delay = limiter.delay(addr[0], len(payload_strings)) if limiter else 0
+                        if delay:
+                            THROTTLED.inc()
+                            time.sleep(delay)
 
-                        # Add payload
-                        client_string = header_data + payload.encode('utf-8')
-
-                        # Send to client
-                        conn.send(client_string)
-                          
                     except ValueError as e:
                         print('ValueError:', e)
-                    except:
+                    except framing.FrameTooLarge as e:
+                        OVERSIZED_FRAMES.inc()
+                        print('Closing connection:', e)
+                        break
+                    except Exception:
                         print("Connection closed or an error occurred")
-                        break
\ No newline at end of file
+                        break
+                    except prefork.Shutdown as e:
+                        # Worker mode: stop accepting, give this connection up to grace seconds to finish
+                        if stopping is not None:
+                            raise
+                        stopping = e
+                        s.close()
+                        deadline = time.monotonic() + (grace or 0)
+            if stopping is not None:
+                raise stopping
+
+# Linux refuses a file descriptor limit over fs.nr_open, which defaults to this
+MAX_FDS = 1 << 20
+
+def raise_fd_limit():
+    # Thousands of concurrent connections need more than the default 1024 file descriptors
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = MAX_FDS if hard == resource.RLIM_INFINITY else min(hard, MAX_FDS)
+    if soft == resource.RLIM_INFINITY or soft >= target:
+        return
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ValueError, OSError) as e:
+        # Not fatal, the server just runs out of descriptors sooner
+        print(f'Could not raise the file descriptor limit to {target}: {e}')
+
+def run_server(args, reuse_port=False, grace=None):
+    # Admission control, per process (every worker enforces its own limits)
+    limiter = admission.RateLimiter(args.rate, args.total_rate, args.burst) if args.rate or args.total_rate else None
+    if args.mode == 'asyncio':
+        # asyncio takes longer to import than the rest of the server, load it only for this engine
+        import asyncio
+        from PA1.aioserver import serve_asyncio
+        raise_fd_limit()
+        sessions = admission.SessionLimit(args.max_sessions)
+        try:
+            asyncio.run(serve_asyncio(args.host, args.port, HEADER_FORMAT, args.quiet, args.backlog, reuse_port,
+                                      limiter, sessions, args.max_payload, grace))
+        except KeyboardInterrupt:
+            pass
+    else:
+        serve_blocking(args.host, args.port, HEADER_FORMAT, args.quiet, reuse_port, limiter, args.max_payload, grace)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Server for packet receiving and unpacking.")
+    parser.add_argument('--host', type=str, default='localhost', help='Server host')
+    parser.add_argument('--port', type=int, default=12345, help='Server port')
+    parser.add_argument('--mode', choices=['blocking', 'asyncio'], default='blocking', help='Server engine (blocking accept loop or concurrent asyncio)')
+    parser.add_argument('--backlog', type=int, default=1024, help='Listen backlog for the asyncio engine')
+    parser.add_argument('--max-sessions', type=int, help='Turn away connections beyond this many at a time (asyncio engine)')
+    parser.add_argument('--rate', type=float, help='Frames per second one client host may send before the server stops reading from it')
+    parser.add_argument('--total-rate', type=float, help='Frames per second across all clients')
+    parser.add_argument('--burst', type=float, help='Frames a client may send at once above its rate (default: one second worth)')
+    parser.add_argument('--max-payload', type=int, help='Close connections whose frames announce a longer payload (bytes)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not print every received packet')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this loopback port (worker N uses this port + N)')
+    parser.add_argument('--workers', type=int, default=0, help='Pre-fork this many worker processes sharing the port through SO_REUSEPORT (0 = serve in this process)')
+    parser.add_argument('--grace', type=float, default=prefork.GRACE_PERIOD, help='Seconds workers get to finish open connections when the supervisor stops')
+
+    args = parser.parse_args()
+
+    if args.workers:
+        # every worker binds its own listening socket, the kernel balances connections between them
+        def serve_worker(index):
+            if args.metrics_port:
+                metrics.serve(args.metrics_port + index)
+            run_server(args, reuse_port=True, grace=args.grace)
+        prefork.run(serve_worker, args.workers, args.grace, name='PA1 worker')
+    else:
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+        run_server(args)
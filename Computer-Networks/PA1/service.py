@@ -0,0 +1,42 @@
+from common import framing
+from common import metrics
+from PA1 import codec
+
+# What both engines of the PA1 server (the blocking loop in server.py and the asyncio one in
+# aioserver.py) share: the metrics, decoding of received frames and the reply.
+
+# Served on --metrics-port
+CONNECTIONS = metrics.counter('pa1_connections', 'Accepted connections')
+PACKETS_IN = metrics.counter('pa1_packets_received', 'Frames received')
+PACKETS_OUT = metrics.counter('pa1_packets_sent', 'Replies sent')
+BYTES_IN = metrics.counter('pa1_bytes_received', 'Bytes of received frames')
+BYTES_OUT = metrics.counter('pa1_bytes_sent', 'Bytes of replies sent')
+PARSE_ERRORS = metrics.counter('pa1_parse_errors', 'Frames whose payload could not be decoded')
+HANDLE_SECONDS = metrics.histogram('pa1_handle_seconds', 'Time from a read to its replies being queued, per read')
+OVERSIZED_FRAMES = metrics.counter('pa1_oversized_frames', 'Connections closed for announcing a payload over --max-payload')
+REJECTED_CONNECTIONS = metrics.counter('pa1_rejected_connections', 'Connections turned away at --max-sessions')
+THROTTLED = metrics.counter('pa1_throttled', 'Times reading from a connection was paused for going over the rate limit')
+
+def decode_payload(service_type, payload_data):
+    # Payload unpacking comes from the codec registered for the service type
+    return codec.decode(service_type, payload_data)
+
+def format_packet(version, header_length, service_type, payload_length, payload):
+    # Return header string
+    return (f"Version: {version}, Header Length: {header_length}, Service Type: {service_type}, Payload_length: {payload_length}\nPayload: {payload}")
+
+def unpack_frame(frame):
+    # Unpacking header information and payload of one received frame
+    (version, header_length, service_type, payload_length), payload_data = frame
+    PACKETS_IN.inc()
+    BYTES_IN.inc(framing.BBBH.header_size + payload_length)
+    try:
+        payload = decode_payload(service_type, payload_data)
+    except ValueError:
+        PARSE_ERRORS.inc()
+        raise
+    return format_packet(version, header_length, service_type, payload_length, payload)
+
+def create_response():
+    # Same reply for every packet, whatever the request: version 1, header length 4, string payload
+    return codec.encode(1, 4, 3, 'Message Recieved')
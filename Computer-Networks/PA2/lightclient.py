@@ -1,6 +1,13 @@
-import argparse
+import os
 import socket
 import struct
+import sys
+
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import asynclog
+from common import framing
 
 def create_packet(version, type, payload):
     header_format = 'III'
@@ -12,7 +19,13 @@ def create_packet(version, type, payload):
     packet = header_data + message
     return packet
 
+# one frame with many commands: a line "<message type> <command>" per command
+def create_batch(version, commands):
+    return create_packet(version, 3, '\n'.join(f'{type} {command}' for type, command in commands))
+
 if __name__ == '__main__':
+    import argparse
+
     parser = argparse.ArgumentParser(description="Client for packet creation and sending.")
     parser.add_argument('-s', '--server', type=str, required=True, help='Server host')
     parser.add_argument('-p', '--port', type=int, default=12345, help='Sever port')
@@ -24,54 +37,53 @@ if __name__ == '__main__':
     # 'globals' for header formatting
     # Fixed header length -> Version (4 bytes), Message type (4 bytes), Message Length (4 bytes)
     header_format = 'III'
-    header_size = struct.calcsize(header_format)
     
     # connect to server
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.connect((args.server, args.port))
-        with open(logfile, 'a') as client_file:
+        reader = framing.FrameReader(s, framing.get_layout(header_format))
+        client_file = asynclog.get_logger(logfile, timestamps=False)
+        
+        # creating first hello reponse to server
+        hello_packet = create_packet(17, 1, 'HELLO')
+        
+        while True:
+            # sending first hello message to server
+            client_file.write('Sending HELLO Packet\n')
+            s.sendall(hello_packet)
             
-            # creating first hello reponse to server
-            hello_packet = create_packet(17, 1, 'HELLO')
+            # receiving first hello response from server
+            hello_response = reader.read_frame()
+            if hello_response is None:
+                raise ConnectionError('Server closed the connection')
             
-            while True:
-                # sending first hello message to server
-                client_file.write('Sending HELLO Packet\n')
-                s.send(hello_packet)
-                
-                # receiving first hello response from server
-                hello_response = s.recv(1024)
-                
-                # decoding first hello response from server
-                header_data = hello_response[:header_size]
-                payload_data = hello_response[header_size:]
-                message = payload_data.decode('utf-8')
-
-                version, type, message_length = struct.unpack(header_format, header_data)
+            # decoding first hello response from server
+            (version, type, message_length), payload_data = hello_response
+            message = str(payload_data, 'utf-8')
+            client_file.write(f'Received Data: version: {version} message_type: {type} length: {message_length}\n')
+            
+            # if version is correct, print message
+            if version == 17:
+                client_file.write(f'VERSION ACCEPTED \nReceived Message {message}\n')
+            else:
+                client_file.write('VERSION MISMATCH\n') 
+                break
+            
+            # sending command to server
+            command_packet = create_packet(17, 1, 'LIGHTON')
+            client_file.write('Sending Command\n')
+            s.sendall(command_packet)
+            
+            # decoding success message
+            success_response = reader.read_frame()
+            if success_response is None:
+                raise ConnectionError('Server closed the connection')
+            (version, type, message_length), payload_data = success_response
+            message = str(payload_data, 'utf-8')
+            if (message == 'UNSUCCESS'): # unsuccessful command
+                client_file.write(f'Received Data: version: {version} message_type: {type} length: {message_length}\n')
+                client_file.write(f'VERSION ACCEPTED\nReceived Message {message} \nCommand Unsuccessful\nClosing Socket\n')
+            else: # successful command
                 client_file.write(f'Received Data: version: {version} message_type: {type} length: {message_length}\n')
-                
-                # if version is correct, print message
-                if version == 17:
-                    client_file.write(f'VERSION ACCEPTED \nReceived Message {message}\n')
-                else:
-                    client_file.write('VERSION MISMATCH\n') 
-                    break
-                
-                # sending command to server
-                command_packet = create_packet(17, 1, 'LIGHTON')
-                client_file.write('Sending Command\n')
-                s.send(command_packet)
-                
-                # decoding success message
-                success_response = s.recv(1024)
-                header_data = success_response[:header_size]
-                payload_data = success_response[header_size:]
-                message = payload_data.decode('utf-8')
-                version, type, message_length = struct.unpack(header_format, header_data)
-                if (message == 'UNSUCCESS'): # unsuccessful command
-                    client_file.write(f'Received Data: version: {version} message_type: {type} length: {message_length}\n')
-                    client_file.write(f'VERSION ACCEPTED\nReceived Message {message} \nCommand Unsuccessful\nClosing Socket\n')
-                else: # successful command
-                    client_file.write(f'Received Data: version: {version} message_type: {type} length: {message_length}\n')
-                    client_file.write(f'VERSION ACCEPTED\nReceived Message {message} \nCommand Successful\nClosing Socket\n')
-                break        
\ No newline at end of file
+                client_file.write(f'VERSION ACCEPTED\nReceived Message {message} \nCommand Successful\nClosing Socket\n')
+            break        
\ No newline at end of file
@@ -0,0 +1,175 @@
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import framing
+from PA2.lightclient import create_batch, create_packet
+
+VERSION = 17
+
+# message type the server expects with each command
+COMMAND_TYPES = {'LIGHTON': 1, 'LIGHTOFF': 2}
+# message type of a BATCH request and of its status bitmap answer
+BATCH = 3
+# commands the server accepts in one BATCH; longer lists are sent as several batches
+MAX_BATCH_COMMANDS = 4096
+
+class VersionMismatch(Exception):
+    pass
+
+# the server refused a whole BATCH instead of answering it with a status bitmap
+class BatchRejected(Exception):
+    pass
+
+# one TCP session to the light server: HELLO is exchanged once, then the session is reused
+class LightConnection:
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = framing.FrameReader(self.sock, framing.III)
+        try:
+            self.handshake()
+        except:
+            self.sock.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def receive(self):
+        version, type, payload_data = self.receive_raw()
+        return version, type, str(payload_data, 'utf-8')
+
+    def receive_raw(self):
+        frame = self.reader.read_frame()
+        if frame is None:
+            raise ConnectionError('Server closed the connection')
+        (version, type, message_length), payload_data = frame
+        return version, type, bytes(payload_data)
+
+    def handshake(self):
+        self.sock.sendall(create_packet(VERSION, 1, 'HELLO'))
+        version, type, message = self.receive()
+        if version != VERSION or message != 'HELLO':
+            raise VersionMismatch(f'Server answered version {version}: {message}')
+
+    # returns True if the server executed the command
+    def command(self, command):
+        self.sock.sendall(create_packet(VERSION, COMMAND_TYPES.get(command, 1), command))
+        version, type, message = self.receive()
+        return message == 'SUCCESS'
+
+    # many commands in one round trip per MAX_BATCH_COMMANDS; returns whether each one was executed
+    def batch(self, commands):
+        results = []
+        for start in range(0, len(commands), MAX_BATCH_COMMANDS):
+            chunk = commands[start:start + MAX_BATCH_COMMANDS]
+            self.sock.sendall(create_batch(VERSION, [(COMMAND_TYPES.get(command.partition(' ')[0], 1), command) for command in chunk]))
+            version, type, bitmap = self.receive_raw()
+            if type != BATCH:
+                raise BatchRejected(f'Server refused a batch of {len(chunk)} commands: {str(bitmap, "utf-8", "replace")}')
+            results += [i >> 3 < len(bitmap) and bool(bitmap[i >> 3] & 1 << (i & 7)) for i in range(len(chunk))]
+        return results
+
+    def close(self):
+        self.sock.close()
+
+# fixed size pool of negotiated connections, safe to share between threads
+class ConnectionPool:
+    def __init__(self, host, port, size=4, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # borrow a connection; connections that fail while borrowed (for any reason, the stream may
+    # be left in the middle of a frame) are closed instead of returned
+    @contextmanager
+    def connection(self):
+        if self._closed:
+            raise RuntimeError('Connection pool is closed')
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = LightConnection(self.host, self.port, self.timeout)
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            if self._closed:
+                conn.close()
+            else:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def command(self, command):
+        with self.connection() as conn:
+            return conn.command(command)
+
+    def batch(self, commands):
+        with self.connection() as conn:
+            return conn.batch(commands)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Send many light commands over a pool of persistent connections.")
+    parser.add_argument('-s', '--server', type=str, required=True, help='Server host')
+    parser.add_argument('-p', '--port', type=int, default=12345, help='Sever port')
+    parser.add_argument('-c', '--connections', type=int, default=4, help='Pooled connections (and sending threads)')
+    parser.add_argument('-n', '--commands', type=int, default=1000, help='Total number of commands to send')
+    parser.add_argument('-b', '--batch', type=int, default=1, help='Commands per BATCH message (1 = one message per command)')
+
+    args = parser.parse_args()
+
+    results = []
+    with ConnectionPool(args.server, args.port, args.connections) as pool:
+        def worker(count):
+            commands = ['LIGHTON' if i % 2 == 0 else 'LIGHTOFF' for i in range(count)]
+            if args.batch > 1:
+                for i in range(0, count, args.batch):
+                    results.extend(pool.batch(commands[i:i + args.batch]))
+            else:
+                for command in commands:
+                    results.append(pool.command(command))
+
+        share, extra = divmod(args.commands, args.connections)
+        threads = [threading.Thread(target=worker, args=(share + (i < extra),)) for i in range(args.connections)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    print(f'{results.count(True)}/{len(results)} commands successful in {elapsed:.3f}s ({len(results) / elapsed:.0f} commands/s over {args.connections} connections)')
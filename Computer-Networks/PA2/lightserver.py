@@ -1,14 +1,128 @@
-import argparse
-import socket
+import os
 import struct
+import sys
+import threading
+import time
 
-def unpack_packet(conn, header_format):
-    # unpack header
-    header_data = conn.recv(struct.calcsize(header_format))
-    version, type, message_length = struct.unpack(header_format, header_data)
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import admission
+from common import asynclog
+from common import binlog
+from common import framing
+from common import metrics
+from common import prefork
+
+# served on --metrics-port
+CONNECTIONS = metrics.counter('pa2_connections', 'Accepted connections')
+PACKETS_IN = metrics.counter('pa2_packets_received', 'Messages received')
+PACKETS_OUT = metrics.counter('pa2_packets_sent', 'Messages sent')
+BYTES_IN = metrics.counter('pa2_bytes_received', 'Bytes of received messages')
+BYTES_OUT = metrics.counter('pa2_bytes_sent', 'Bytes of sent messages')
+VERSION_MISMATCHES = metrics.counter('pa2_version_mismatches', 'Messages with a version other than 17')
+PARSE_ERRORS = metrics.counter('pa2_parse_errors', 'Messages that were not valid UTF-8')
+HANDSHAKE_SECONDS = metrics.histogram('pa2_handshake_seconds', 'Time from accepting a connection to answering its HELLO')
+COMMAND_SECONDS = metrics.histogram('pa2_command_seconds', 'Time to handle one message, by command', ['command'])
+BATCH_COMMANDS = metrics.counter('pa2_batch_commands', 'Commands received inside BATCH messages')
+OVERSIZED_MESSAGES = metrics.counter('pa2_oversized_messages', 'Connections closed for announcing a message over --max-message')
+REJECTED_CONNECTIONS = metrics.counter('pa2_rejected_connections', 'Connections turned away at --max-sessions')
+THROTTLED = metrics.counter('pa2_throttled', 'Times a session paused reading for going over the rate limit')
+
+# longest message read from a client; the 32-bit length field is not trusted beyond this
+MAX_MESSAGE = 256 * 1024
+
+# message type of a BATCH: one frame carrying many commands, answered with a status bitmap.
+# A batch of more than MAX_BATCH_COMMANDS is answered with UNSUCCESS (type 1) instead.
+BATCH = 3
+MAX_BATCH_COMMANDS = 4096
+
+# (message type, command) -> handler(argument), True if the command was executed.
+# A message is "COMMAND" or "COMMAND ARGUMENT" (e.g. a device number); more devices are
+# added by registering their commands with @command_handler.
+HANDLERS = {}
+
+def command_handler(type, command):
+    def register(handler):
+        HANDLERS[(type, command)] = handler
+        return handler
+    return register
+
+@command_handler(1, 'LIGHTON')
+def light_on(argument):
+    return True
+
+@command_handler(2, 'LIGHTOFF')
+def light_off(argument):
+    return True
+
+# None for a command nobody registered, otherwise whether its handler succeeded
+def dispatch(type, message):
+    command, _, argument = message.partition(' ')
+    handler = HANDLERS.get((type, command))
+    if handler is None:
+        return None
+    try:
+        return bool(handler(argument))
+    except Exception:
+        return False
+
+# BATCH payload: one command per line, "<message type> <command>[ <argument>]"
+def parse_batch(message):
+    entries = []
+    for line in message.split('\n') if message else ():
+        type, _, command = line.partition(' ')
+        entries.append((int(type) if type.isdigit() else None, command))
+    return entries
+
+# number of commands in a BATCH payload, counted without splitting it
+def batch_size(message):
+    return message.count('\n') + 1 if message else 0
+
+# bit i (least significant bit first) of the answer is set if command i of the batch succeeded
+def create_bitmap(results):
+    bitmap = bytearray((len(results) + 7) // 8)
+    for i, success in enumerate(results):
+        if success:
+            bitmap[i >> 3] |= 1 << (i & 7)
+    return bytes(bitmap)
+
+def create_batch_reply(version, results):
+    bitmap = create_bitmap(results)
+    return struct.pack('III', version, BATCH, len(bitmap)) + bitmap
+
+# text lines, or with --log-format binary structured records (see common/binlog.py)
+log_format = 'text'
+
+def open_log(logfile):
+    if log_format == 'binary':
+        # the free-form lines only repeat what the packet records hold
+        return binlog.get_logger(logfile, events=False)
+    return asynclog.get_logger(logfile, timestamps=False)
+
+# metric label of a message, bounded to the commands the server knows
+def command_label(type, message):
+    if type == BATCH:
+        return 'BATCH'
+    command = message.partition(' ')[0]
+    if command == 'HELLO' or (type, command) in HANDLERS:
+        return command
+    return 'other'
+
+def unpack_packet(reader):
+    # receive a whole frame (header and message) from the connection's frame reader
+    frame = reader.read_frame()
+    if frame is None:
+        raise ConnectionError('Connection closed')
+    (version, type, message_length), payload_data = frame
+    PACKETS_IN.inc()
+    BYTES_IN.inc(framing.III.header_size + message_length)
     # decode message
-    payload_data = conn.recv(message_length)
-    message = payload_data.decode('utf-8')
+    try:
+        message = str(payload_data, 'utf-8')
+    except UnicodeDecodeError:
+        PARSE_ERRORS.inc()
+        raise
     
     if version != 17: # version mismatch
         return None
@@ -25,10 +139,138 @@ def create_packet(version, type, payload):
     packet = header_data + message
     return packet
 
+def send_packet(conn, packet, log=None, peer=None):
+    conn.sendall(packet)
+    PACKETS_OUT.inc()
+    BYTES_OUT.inc(len(packet))
+    if log is not None:
+        version, type, _ = struct.unpack_from('III', packet)
+        text = packet[12:].hex() if type == BATCH else str(packet[12:], 'utf-8')
+        log.packet(binlog.SEND, version=version, type=type, peer=peer, text=text)
+
+def handle_connection(conn, addr, logfile, header_format, limiter=None, max_message=MAX_MESSAGE):
+    # one session per connection: HELLO negotiates the version once, then any number of commands
+    # log lines go through the shared background writer instead of this thread's file handle
+    accepted = time.perf_counter()
+    CONNECTIONS.inc()
+    server_file = open_log(logfile)
+    binary = log_format == 'binary'
+    if binary:
+        server_file.packet(binlog.EVENT, peer=addr, text='Received connection')
+    server_file.write(f'Received connection from (IP, PORT): ({addr[0]}, {addr[1]})\n')
+    with conn:
+        reader = framing.FrameReader(conn, framing.get_layout(header_format), max_payload=max_message)
+        negotiated = False
+        while True:
+            try:
+                payload = unpack_packet(reader)
+                received = time.perf_counter()
+                commands = 1 # charged to the rate limit
+                if binary and payload is not None:
+                    server_file.packet(binlog.RECV, version=payload[0], type=payload[1], peer=addr, text=payload[3])
+                
+                if payload is None: # Version mismatch
+                    VERSION_MISMATCHES.inc()
+                    server_file.write('VERSION MISMATCH\n')
+                    break
+                elif payload[3] == 'HELLO': # Initial hello response from client
+                    server_file.write(f'Received Data: version: {payload[0]} message_type: {payload[1]} length: {payload[2]}\nVERSION ACCEPTED\n')
+                    # sending hello response back to client
+                    hello_packet = create_packet(17, 1, 'HELLO')
+                    send_packet(conn, hello_packet, server_file if binary else None, addr)
+                    if not negotiated:
+                        HANDSHAKE_SECONDS.observe(time.perf_counter() - accepted)
+                    negotiated = True
+                elif not negotiated: # commands are only accepted once the session said HELLO
+                    server_file.write(f'Received Data: version: {payload[0]} message_type: {payload[1]} length: {payload[2]}\nCOMMAND BEFORE HELLO: {payload[3]}\n')
+                    unsuccess_packet = create_packet(17, 1, 'UNSUCCESS')
+                    send_packet(conn, unsuccess_packet, server_file if binary else None, addr)
+                elif payload[1] == BATCH: # many commands, one status bit each
+                    server_file.write(f'Received Data: version: {payload[0]} message_type: {payload[1]} length: {payload[2]}\nVERSION ACCEPTED\n')
+                    commands = batch_size(payload[3])
+                    BATCH_COMMANDS.inc(commands)
+                    if commands > MAX_BATCH_COMMANDS: # refused as a whole, before parsing it
+                        server_file.write(f'IGNORING BATCH OF {commands} COMMANDS (limit {MAX_BATCH_COMMANDS})\n')
+                        unsuccess_packet = create_packet(17, 1, 'UNSUCCESS')
+                        send_packet(conn, unsuccess_packet, server_file if binary else None, addr)
+                    else:
+                        results = [type is not None and dispatch(type, command) is True for type, command in parse_batch(payload[3])]
+                        server_file.write(f'EXECUTING BATCH OF {commands} COMMANDS: {results.count(True)} SUCCESSFUL\n')
+                        send_packet(conn, create_batch_reply(17, results), server_file if binary else None, addr)
+                else: # support command and sending success
+                    server_file.write(f'Received Data: version: {payload[0]} message_type: {payload[1]} length: {payload[2]}\nVERSION ACCEPTED\n')
+                    result = dispatch(payload[1], payload[3])
+                    if result is None: # unsupported message types
+                        server_file.write(f'IGNORING UNKNOWN COMMAND: {payload[3]}\n')
+                        unsuccess_packet = create_packet(17, 1, 'UNSUCCESS')
+                        send_packet(conn, unsuccess_packet, server_file if binary else None, addr)
+                    else: # supported message types
+                        server_file.write(f'EXECUTING SUPPORTED COMMAND: {payload[3]}\n')
+                        # sending the handler's result back to client
+                        server_file.write(f"Returning {'SUCCESS' if result else 'UNSUCCESS'}\n")
+                        result_packet = create_packet(17, 1, 'SUCCESS' if result else 'UNSUCCESS')
+                        send_packet(conn, result_packet, server_file if binary else None, addr)
+                COMMAND_SECONDS.labels(command_label(payload[1], payload[3])).observe(time.perf_counter() - received)
+
+                # over the rate limit: this session stops reading, TCP flow control slows the client down
+                delay = limiter.delay(addr[0], commands) if limiter else 0
+                if delay:
+                    THROTTLED.inc()
+                    time.sleep(delay)
+            except framing.FrameTooLarge as e:
+                OVERSIZED_MESSAGES.inc()
+                server_file.write(f'MESSAGE TOO LARGE: {e}\n')
+                break
+            except:
+                print('Error occurred or Connection closed')
+                break
+
+def serve(host, port, logfile, header_format, reuse_port=False, grace=None,
+          limiter=None, max_sessions=None, max_message=MAX_MESSAGE):
+    active = set() # session threads still running
+    sessions = admission.SessionLimit(max_sessions)
+    def session(conn, addr):
+        try:
+            handle_connection(conn, addr, logfile, header_format, limiter, max_message)
+        finally:
+            sessions.close()
+            active.discard(threading.current_thread())
+
+    with prefork.listen_socket(host, port, reuse_port=reuse_port) as s:
+        try:
+            while True: # Keep server running
+                conn, addr = s.accept()
+                if not sessions.open(): # at --max-sessions: turn the client away instead of queueing it
+                    REJECTED_CONNECTIONS.inc()
+                    conn.close()
+                    continue
+                # every session gets its own thread, so long lived (pooled) connections are served side by side
+                thread = threading.Thread(target=session, args=(conn, addr), daemon=True)
+                active.add(thread)
+                thread.start()
+        except prefork.Shutdown:
+            # worker mode: stop accepting, give open sessions up to grace seconds to finish
+            s.close()
+            deadline = time.monotonic() + (grace or 0)
+            for thread in list(active):
+                thread.join(max(deadline - time.monotonic(), 0))
+            raise
+
 if __name__ == '__main__':
+    import argparse
+
     parser = argparse.ArgumentParser(description="Client for packet creation and sending.")
     parser.add_argument('-p', '--port', type=int, default=12345, help='Sever port')
     parser.add_argument('-l', '--logfile', type=str, required=True, help='Log file location')
+    parser.add_argument('--log-format', choices=('text', 'binary'), default='text', help='Log text lines or binary records (query with common/binlog.py; with --workers, one log per worker, PATH.N)')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this loopback port (worker N uses this port + N)')
+    parser.add_argument('--max-sessions', type=int, help='Turn away connections beyond this many at a time')
+    parser.add_argument('--rate', type=float, help='Commands per second one client host may send before its sessions stop reading')
+    parser.add_argument('--total-rate', type=float, help='Commands per second across all clients')
+    parser.add_argument('--burst', type=float, help='Commands a client may send at once above its rate (default: one second worth)')
+    parser.add_argument('--max-message', type=int, default=MAX_MESSAGE, help='Close connections whose messages announce more bytes than this')
+    parser.add_argument('--workers', type=int, default=0, help='Pre-fork this many worker processes sharing the port through SO_REUSEPORT (0 = serve in this process)')
+    parser.add_argument('--grace', type=float, default=prefork.GRACE_PERIOD, help='Seconds workers get to finish open sessions when the supervisor stops')
     
     args = parser.parse_args()
     
@@ -36,42 +278,27 @@ if __name__ == '__main__':
     host = 'localhost'
     port = args.port
     logfile = args.logfile
+    log_format = args.log_format
     
     # Fixed header length -> Version (4 bytes), Message type (4 bytes), Message Length (4 bytes)
     header_format = 'III'
+    # admission control, per process (every worker enforces its own limits)
+    limiter = admission.RateLimiter(args.rate, args.total_rate, args.burst) if args.rate or args.total_rate else None
+    limits = dict(limiter=limiter, max_sessions=args.max_sessions, max_message=args.max_message)
     
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((host, port))
-        s.listen()
-        while True: # Keep server running
-            conn, addr = s.accept()
-            with open(logfile, 'a') as server_file:
-                server_file.write(f'Received connection from (IP, PORT): ({host}, {port})\n')
-                with conn:
-                    while True:
-                        try:
-                            payload = unpack_packet(conn, header_format)
-                            
-                            if payload is None: # Version mismatch
-                                server_file.write('VERSION MISMATCH\n')
-                                break
-                            elif payload[3] == 'HELLO': # Initial hello response from client
-                                server_file.write(f'Received Data: version: {payload[0]} message_type: {payload[1]} length: {payload[2]}\nVERSION ACCEPTED\n')
-                                # sending hello response back to client
-                                hello_packet = create_packet(17, 1, 'HELLO')
-                                conn.send(hello_packet)
-                            else: # support command and sending success
-                                server_file.write(f'Received Data: version: {payload[0]} message_type: {payload[1]} length: {payload[2]}\nVERSION ACCEPTED\n')
-                                if (payload[1] == 1 and payload[3] == 'LIGHTON') or (payload[1] == 2 and payload[3] == 'LIGHTOFF'): # supported message types
-                                    server_file.write(f'EXECUTING SUPPORTED COMMAND: {payload[3]}\n')
-                                     # sending success message back to client
-                                    server_file.write('Returning SUCCESS\n')
-                                    success_packet = create_packet(17, 1, 'SUCCESS')
-                                    conn.send(success_packet)
-                                else: # unsupported message types
-                                    server_file.write(f'IGNORING UNKNOWN COMMAND: {payload[3]}\n')
-                                    unsuccess_packet = create_packet(17, 1, 'UNSUCCESS')
-                                    conn.send(unsuccess_packet)
-                        except:
-                            print('Error occurred or Connection closed')
-                            break
\ No newline at end of file
+    if args.workers:
+        # every worker binds its own listening socket, the kernel balances connections between them
+        def serve_worker(index):
+            if args.metrics_port:
+                metrics.serve(args.metrics_port + index)
+            # a binary log has one writer: every worker keeps its own, PATH.0, PATH.1, ...
+            worker_log = f'{logfile}.{index}' if log_format == 'binary' else logfile
+            try:
+                serve(host, port, worker_log, header_format, reuse_port=True, grace=args.grace, **limits)
+            finally:
+                asynclog.close_all() # workers leave through os._exit, which skips atexit
+        prefork.run(serve_worker, args.workers, args.grace, name='PA2 worker')
+    else:
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+        serve(host, port, logfile, header_format, **limits)
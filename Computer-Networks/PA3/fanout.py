@@ -0,0 +1,317 @@
+import os
+import random
+import selectors
+import socket
+import sys
+import time
+
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PA3 import gpio
+from PA3 import lightclient as client
+from PA3 import pir
+from PA3 import reliable
+from PA3 import wire
+
+# Fan-out: one PIR sensor blinks the LEDs of many light servers. The client keeps a session
+# to every server on one unconnected UDP socket. A motion event is queued on every session's
+# sliding window and the whole pass leaves in one sendmmsg (wire.send_batch), so the last
+# receiver gets it microseconds after the first instead of one send call per server later.
+# Each server's ACK is timed, and the report gives the spread between the fastest and the
+# slowest receiver of every event.
+
+PIN = 32
+# servers that have not answered the SYN by then are left out, instead of holding up the rest
+CONNECT_TIMEOUT = 5.0
+
+# one motion event as sent to every server
+class FanoutEvent:
+    def __init__(self, edge, sessions):
+        self.edge = edge # the pir.MotionEvent
+        self.unsent = sessions # sessions that have not transmitted it yet (their window was full)
+        self.sent = None # perf_counter when the send pass was flushed
+        self.pass_seconds = None # time to queue the event on every session and send it
+        self.calls = None # system calls of the send pass
+        self.acks = {} # server address -> seconds from the send pass to its ACK
+
+# one session of the fan-out, to the server at address; its packets are logged to log
+class Peer:
+    def __init__(self, address, outbox, log, window, varlen=False, compress=False, connect_timeout=CONNECT_TIMEOUT):
+        self.address = address
+        self.outbox = outbox
+        self.log = log
+        self.window = window
+        self.offer = {'varlen': varlen, 'compress': compress}
+        self.seq_num = random.randint(0, 100)
+        self.rtt = reliable.RttEstimator()
+        self.format = {} # payload format the server accepted in the handshake
+        self.server_seq = None
+        self.sender = None # set once the handshake is done
+        self.connect_timeout = connect_timeout
+        self.syn_attempts = 0
+        self.first_syn_at = None
+        self.syn_sent_at = None
+        self.syn_deadline = None
+        self.events = {} # sequence number -> index of the motion event it carries, until ACKed
+        self.failed = None # why the session was given up
+
+    def established(self):
+        return self.sender is not None
+
+    def send_syn(self):
+        if self.syn_attempts:
+            self.rtt.backoff()
+        header_data, payload_data = client.create_packet(self.log, sequence_number=self.seq_num, syn=1, peer=self.address, **self.offer)
+        self.outbox.add(header_data, payload_data, self.address)
+        self.syn_attempts += 1
+        self.syn_sent_at = time.monotonic()
+        if self.first_syn_at is None:
+            self.first_syn_at = self.syn_sent_at
+        self.syn_deadline = self.syn_sent_at + self.rtt.rto
+
+    # sliding window callback: the packet joins the current send pass
+    def transmit(self, seq, fields):
+        header_data, payload_data = client.create_packet(self.log, sequence_number=seq, ack_number=self.server_seq + 1,
+                                                         peer=self.address, **self.format, **fields)
+        self.outbox.add(header_data, payload_data, self.address)
+
+    # queue a motion event on this session; index is reported back when it is ACKed.
+    # on_sent() runs when the event is handed to the send pass.
+    def send_event(self, index, on_sent=None):
+        self.events[self.sender.next_seq + len(self.sender.pending)] = index
+        self.sender.send(on_sent=on_sent, payload=':MotionDetected')
+
+    # handle one packet from the server, returns the motion events it acknowledged
+    def packet_received(self, header_data, payload_data):
+        options = wire.options(header_data)
+        seq, ack_number, ack, syn, fin, payload = client.unpack_packet(self.log, header_data, payload_data, self.address)
+        if syn and ack:
+            if ack_number != self.seq_num + 1:
+                return []
+            if self.sender is None:
+                if self.syn_attempts == 1: # Karn's rule, a retransmitted SYN gives no usable sample
+                    self.rtt.sample(time.monotonic() - self.syn_sent_at)
+                self.server_seq = seq
+                self.format = {'varlen': bool(options & wire.VARLEN), 'compress': bool(options & wire.COMPRESSED)}
+                self.syn_deadline = None
+                self.sender = reliable.Sender(self.transmit, ack_number, window=self.window, rtt=self.rtt)
+            # ACK the SYN|ACK (again, if ours was lost and the server repeated it)
+            header_data, payload_data = client.create_packet(self.log, sequence_number=ack_number, ack_number=seq + 1, ack=1,
+                                                             peer=self.address, **self.format)
+            self.outbox.add(header_data, payload_data, self.address)
+            return []
+        if not ack or self.sender is None or not self.sender.ack_received(ack_number):
+            return []
+        acked = [seq for seq in self.events if seq < ack_number]
+        return [self.events.pop(seq) for seq in acked]
+
+    # SYN or data retransmissions that are due
+    def check_timers(self, now):
+        if self.sender is not None:
+            self.sender.check_timers()
+        elif self.syn_deadline is not None and now >= min(self.syn_deadline, self.first_syn_at + self.connect_timeout):
+            if now - self.first_syn_at >= self.connect_timeout:
+                raise TimeoutError(f'No SYN|ACK after {self.syn_attempts} SYNs')
+            self.send_syn()
+
+    # seconds until the next retransmission, None when nothing is outstanding
+    def timeout(self, now):
+        if self.sender is not None:
+            return self.sender.timeout()
+        if self.syn_deadline is not None:
+            return max(min(self.syn_deadline, self.first_syn_at + self.connect_timeout) - now, 0)
+        return None
+
+def parse_address(server):
+    host, _, port = server.rpartition(':')
+    if not host: # no port given
+        host, port = server, 12345
+    return socket.gethostbyname(host), int(port)
+
+# handshake with every server, configure them, send --motion-events motion events to all of
+# them, FIN. Returns (sessions, events, edge to send latencies).
+def run(args, GPIO, log, say=print):
+    addresses = list(dict.fromkeys(parse_address(server) for server in args.servers))
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.setblocking(False)
+        transport = s
+        if args.loss or args.delay:
+            # testing: drop/delay our own datagrams to exercise retransmission
+            transport = reliable.LossyTransport(s, args.loss, args.delay, args.delay / 2)
+        outbox = wire.Outbox(transport)
+        offer_varlen = not args.fixed_payload
+        peers = {address: Peer(address, outbox, log, args.window, offer_varlen, offer_varlen and args.compress, args.connect_timeout)
+                 for address in addresses}
+        events = []
+        latencies = []
+        transmitted = [] # motion events handed to the outbox since the last flush
+        buffer = memoryview(bytearray(wire.MAX_PACKET_SIZE))
+        selector = selectors.DefaultSelector()
+        selector.register(s, selectors.EVENT_READ)
+
+        def live():
+            return [peer for peer in peers.values() if peer.failed is None]
+
+        # send the pass; an event's edge to send latency is taken once the last session sent it,
+        # which includes the time it waited for room in a session's window
+        def flush():
+            calls = outbox.flush()
+            now = time.perf_counter()
+            for event in transmitted:
+                event.unsent -= 1
+                if event.unsent == 0:
+                    latencies.append(now - event.edge.edge_time)
+            transmitted.clear()
+            return calls
+
+        # wait for packets (and the sensor, once registered) for at most the next retransmission
+        # timeout, handle them, fire due timers and send everything queued in one pass.
+        # Returns True if the sensor has events.
+        def step():
+            now = time.monotonic()
+            timeouts = [timeout for timeout in (peer.timeout(now) for peer in live()) if timeout is not None]
+            sensor_ready = False
+            for key, _ in selector.select(min(timeouts + [1.0])):
+                if key.fileobj is not s:
+                    sensor_ready = True
+                    continue
+                while True:
+                    try:
+                        nbytes, address = s.recvfrom_into(buffer)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    received = time.perf_counter()
+                    peer = peers.get(address)
+                    if peer is None or peer.failed is not None or nbytes < wire.HEADER_SIZE:
+                        continue
+                    try:
+                        acknowledged = peer.packet_received(buffer[:wire.HEADER_SIZE], buffer[wire.HEADER_SIZE:nbytes])
+                    except ValueError as e: # malformed payload
+                        client.message_log(log, f'Dropping packet from {address}: {e}\n')
+                        continue
+                    for index in acknowledged:
+                        events[index].acks[address] = received - events[index].sent
+            now = time.monotonic()
+            for peer in live():
+                try:
+                    peer.check_timers(now)
+                except TimeoutError as e:
+                    peer.failed = str(e)
+                    say(f'Giving up on {peer.address[0]}:{peer.address[1]}: {e}')
+            flush()
+            return sensor_ready
+
+        # send SYN to every server in one pass, receive the SYN|ACKs
+        for peer in peers.values():
+            peer.send_syn()
+        flush()
+        say(f'Sent SYN to {len(peers)} servers')
+        while any(not peer.established() for peer in live()):
+            step()
+        say(f'{len(live())} sessions established')
+
+        # send duration and blinks
+        for peer in live():
+            peer.sender.send(payload='Duration: 1, Blinks: 5')
+        flush()
+        while any(not peer.sender.idle() for peer in live()):
+            step()
+        say('Servers configured')
+
+        # every motion edge goes to all servers in one batched pass
+        sensor = pir.MotionSensor(GPIO, PIN, debounce=args.debounce)
+        selector.register(sensor, selectors.EVENT_READ)
+        while len(events) < args.motion_events:
+            if not step():
+                continue
+            for edge in sensor.pop_events():
+                if len(events) == args.motion_events:
+                    break
+                started = time.perf_counter()
+                event = FanoutEvent(edge, len(live()))
+                events.append(event)
+                for peer in live():
+                    peer.send_event(len(events) - 1, lambda event=event: transmitted.append(event))
+                event.calls = flush()
+                event.sent = time.perf_counter()
+                event.pass_seconds = event.sent - started
+                say(f'Sent motion update to {len(live())} servers in {event.calls} system calls')
+        selector.unregister(sensor)
+        sensor.close()
+
+        # receive ACKs for the motion updates
+        while any(not peer.sender.idle() for peer in live()):
+            step()
+
+        # send FIN
+        for peer in live():
+            peer.sender.send(fin=1)
+        flush()
+        while any(not peer.sender.idle() for peer in live()):
+            step()
+        selector.close()
+        return list(peers.values()), events, latencies
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def report(peers, events, latencies):
+    failed = [peer for peer in peers if peer.failed is not None]
+    print(f'{len(peers) - len(failed)}/{len(peers)} sessions completed, {len(events)} motion events, '
+          f'{sum(peer.sender.retransmissions for peer in peers if peer.sender is not None)} retransmissions')
+    if not events:
+        return
+    acks = sorted(latency for event in events for latency in event.acks.values())
+    spreads = sorted(max(event.acks.values()) - min(event.acks.values()) for event in events if event.acks)
+    passes = sorted(event.pass_seconds for event in events)
+    if latencies:
+        latencies.sort()
+        print(f'Edge to send latency: median {latencies[len(latencies) // 2] * 1e6:.0f}us, max {latencies[-1] * 1e6:.0f}us')
+    print(f'Send pass: median {percentile(passes, 0.5) * 1e6:.0f}us, max {passes[-1] * 1e6:.0f}us, '
+          f'{max(event.calls for event in events)} system calls at most')
+    if acks:
+        print(f'ACK latency: median {percentile(acks, 0.5) * 1e6:.0f}us, p99 {percentile(acks, 0.99) * 1e6:.0f}us, '
+              f'max {acks[-1] * 1e6:.0f}us')
+        print(f'Receiver spread (slowest - fastest ACK per event): median {percentile(spreads, 0.5) * 1e6:.0f}us, '
+              f'p99 {percentile(spreads, 0.99) * 1e6:.0f}us, max {spreads[-1] * 1e6:.0f}us')
+    for peer in failed:
+        print(f'Session to {peer.address[0]}:{peer.address[1]} failed: {peer.failed}')
+
+if __name__ == '__main__':
+    import argparse
+
+    # parse arguments
+    args = argparse.ArgumentParser(description="Send every motion event to many light servers at once")
+    args.add_argument("-s", "--servers", nargs='+', required=True, help='Servers as HOST:PORT (port 12345 if left out)')
+    args.add_argument("-l", "--logfile", type=str, default='fanout_log.txt', help='Log file location')
+    args.add_argument("--log-format", choices=('text', 'binary'), default='text', help='Log text lines or binary records (query with common/binlog.py)')
+    args.add_argument("--fixed-payload", action='store_true', help='Do not offer variable length payloads (always pad to 32 bytes)')
+    args.add_argument("--compress", action='store_true', help='Offer zlib compression of long payloads')
+    args.add_argument("--connect-timeout", type=float, default=CONNECT_TIMEOUT, help='Seconds a server gets to answer the SYN before it is left out')
+    args.add_argument("-w", "--window", type=int, default=4, help='Messages per server that may be in flight before waiting for ACKs')
+    args.add_argument("-m", "--motion-events", type=int, default=1, help='Motion updates to send before FIN')
+    args.add_argument("--debounce", type=float, default=0.5, help='Ignore PIR edges closer together than this (seconds)')
+    args.add_argument("--gpio", choices=gpio.BACKENDS, default=gpio.RPI, help='GPIO backend: RPi.GPIO or simulated in memory')
+    args.add_argument("--pir-rate", type=float, default=1.0, help='Simulated GPIO: PIR edges per second')
+    args.add_argument("--loss", type=float, default=0.0, help='Testing: probability of dropping an outgoing datagram')
+    args.add_argument("--delay", type=float, default=0.0, help='Testing: delay added to outgoing datagrams (seconds)')
+    args = args.parse_args()
+
+    # packets are created and logged by the client module
+    log = client.open_log(args.logfile, args.log_format)
+
+    # GPIO code
+    GPIO = gpio.load(args.gpio, args.pir_rate)
+    GPIO.setwarnings(False)
+    GPIO.setmode(GPIO.BOARD)
+
+    try:
+        report(*run(args, GPIO, log))
+    except KeyboardInterrupt:
+        print("\nExiting program.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        exit(1)
+    finally:
+        GPIO.cleanup()
@@ -0,0 +1,142 @@
+import heapq
+import importlib
+import itertools
+import random
+import threading
+import time
+
+# GPIO backends. Both scripts talk to whatever load() returns through the RPi.GPIO calls
+# they already use (setmode, setup, input, output, add_event_detect, cleanup):
+#   rpi - the real RPi.GPIO module, imported only when this backend is chosen
+#   sim - SimulatedGPIO, in memory: records output transitions and produces PIR edges
+
+RPI = 'rpi'
+SIMULATED = 'sim'
+BACKENDS = (RPI, SIMULATED)
+
+def load(backend=RPI, pir_rate=1.0, seed=None):
+    if backend == RPI:
+        return importlib.import_module('RPi.GPIO')
+    if backend == SIMULATED:
+        return SimulatedGPIO(pir_rate, seed)
+    raise ValueError(f'Unknown GPIO backend: {backend}')
+
+# one thread produces the edges of every simulated input in the process, so hundreds of
+# virtual sensors cost one thread instead of hundreds
+class _EdgeSource:
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._wakeup = threading.Condition()
+        self._firing = threading.RLock() # held while a callback runs, see remove()
+        self._thread = None
+
+    def add(self, when, detector):
+        with self._wakeup:
+            heapq.heappush(self._heap, (when, next(self._order), detector))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='simulated GPIO edges', daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._wakeup.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, detector = heapq.heappop(self._heap)
+            with self._firing:
+                if not detector.active:
+                    continue
+                # a failing callback must not end this thread: every simulated sensor depends on it
+                try:
+                    detector.fire()
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+            self.add(time.monotonic() + detector.gpio.random.expovariate(detector.gpio.pir_rate), detector)
+
+    # once this returns the detector's callback is not running and is never called again, so
+    # the caller may release what the callback uses (e.g. close its pipe)
+    def remove(self, detector):
+        with self._firing:
+            detector.active = False
+
+_edges = _EdgeSource()
+
+class _Detector:
+    def __init__(self, gpio, pin, callback):
+        self.gpio = gpio
+        self.pin = pin
+        self.callback = callback
+        self.active = True
+
+    # the PIR output goes high (motion) and back low, one rising edge
+    def fire(self):
+        self.gpio.levels[self.pin] = self.gpio.HIGH
+        self.gpio.edges += 1
+        try:
+            if self.callback is not None:
+                self.callback(self.pin)
+        finally:
+            self.gpio.levels[self.pin] = self.gpio.LOW
+
+# in memory stand-in for RPi.GPIO. Outputs are recorded in transitions as
+# (time.monotonic(), pin, value); inputs with event detection produce rising edges at random
+# intervals averaging pir_rate per second.
+class SimulatedGPIO:
+    BOARD = 10
+    BCM = 11
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, pir_rate=1.0, seed=None):
+        self.pir_rate = pir_rate
+        self.random = random.Random(seed)
+        self.mode = None
+        self.levels = {}
+        self.transitions = []
+        self.edges = 0 # simulated PIR edges so far
+        self._detectors = {}
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, initial=LOW, **kwargs):
+        self.levels[pin] = initial
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def output(self, pin, value):
+        if self.levels.get(pin) != value:
+            self.transitions.append((time.monotonic(), pin, value))
+        self.levels[pin] = value
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        if pin in self._detectors:
+            raise RuntimeError(f'Conflicting edge detection already enabled for pin {pin}')
+        detector = self._detectors[pin] = _Detector(self, pin, callback)
+        if self.pir_rate > 0:
+            _edges.add(time.monotonic() + self.random.expovariate(self.pir_rate), detector)
+
+    def remove_event_detect(self, pin):
+        detector = self._detectors.pop(pin, None)
+        if detector is not None:
+            _edges.remove(detector)
+
+    # times an output went high, e.g. how often an LED blinked
+    def pulses(self, pin):
+        return sum(1 for _, transition_pin, value in self.transitions if transition_pin == pin and value == self.HIGH)
+
+    def cleanup(self):
+        for pin in list(self._detectors):
+            self.remove_event_detect(pin)
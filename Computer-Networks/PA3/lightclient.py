@@ -1,21 +1,48 @@
-import argparse
+import os
+import random
 import socket
 import struct
+import sys
 import time
-import random
-from datetime import datetime
-import RPi.GPIO as GPIO
+import selectors
+import threading
+
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import asynclog
+from common import binlog
+from PA3 import gpio
+from PA3 import pir
+from PA3 import reliable
+from PA3 import wire
 
 HEADER_FORMAT = '>III'
 
+# board pin of the PIR sensor
+PIN = 32
+
+# text lines, or with log_format 'binary' structured records (see common/binlog.py); queued,
+# written and timestamped by a background thread
+def open_log(logfile, log_format='text'):
+    if log_format == 'binary':
+        return binlog.get_logger(logfile)
+    return asynclog.get_logger(logfile)
+
 # for message logging
-def message_log(logfile, message):
-    timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    with open(logfile, 'a') as log_file:
-        log_file.write(f"[{timestamp}] {message}")
+def message_log(log, message):
+    log.log(message)
+
+# one SEND/RECV line per packet
+def packet_log(log, direction, sequence_number, ack_number, ack, syn, fin, payload=None, peer=None):
+    if log.binary:
+        log.packet(binlog.SEND if direction == 'SEND' else binlog.RECV, sequence_number, ack_number,
+                   (ack << 2) | (syn << 1) | fin, peer=peer, text=payload or None)
+    else:
+        message_log(log, f"\"{direction}\" <{sequence_number}> <{ack_number}> [{ack}] [{syn}] [{fin}]\n")
         
 # create packet from from parameters
-def create_packet(**kwargs):
+def create_packet(log, **kwargs):
     # get values from parameters
     sequence_number = kwargs.get('sequence_number', 0)
     ack_number = kwargs.get('ack_number', 0)
@@ -23,6 +50,10 @@ def create_packet(**kwargs):
     ack = kwargs.get('ack', 0)
     syn = kwargs.get('syn', 0)
     fin = kwargs.get('fin', 0)
+    peer = kwargs.get('peer')
+    # payload format negotiated by the handshake (see wire.py)
+    varlen = kwargs.get('varlen', False)
+    compress = kwargs.get('compress', False)
 
     # get flag values
     flags = 0
@@ -31,114 +62,250 @@ def create_packet(**kwargs):
     flags |= fin
 
     # pack header and payload
-    header_data = struct.pack(HEADER_FORMAT, sequence_number, ack_number, flags)
-    payload_data = payload.encode('utf-8').ljust(32, b'\x00')
+    options, payload_data = wire.pack_payload(payload.encode('utf-8'), syn, varlen, compress)
+    header_data = struct.pack(HEADER_FORMAT, sequence_number, ack_number, flags | options)
         
-    message_log(logfile, f"\"SEND\" <{sequence_number}> <{ack_number}> [{ack}] [{syn}] [{fin}]\n")
+    packet_log(log, 'SEND', sequence_number, ack_number, ack, syn, fin, payload.rstrip('\x00'), peer)
 
     return header_data, payload_data
 
 # unpack packet information
-def unpack_packet(header_data, payload_data):
+def unpack_packet(log, header_data, payload_data, peer=None):
     # unpack header
     sequence_number, ack_number, flags = struct.unpack(HEADER_FORMAT, header_data)
+    # receive and decode payload (fixed 32 bytes or length prefixed, by the flags)
+    payload = str(wire.unpack_payload(flags, payload_data), 'utf-8').rstrip('\x00')
     # extract flag bits
     flags = flags & 0b111
     ack = (flags >> 2) & 0b1
     syn = (flags >> 1) & 0b1
     fin = flags & 0b1
-    # receive and decode payload
-    payload = payload_data.decode('utf-8').rstrip('\x00')
-    message_log(logfile, f"\"RECV\" <{sequence_number}> <{ack_number}> [{ack}] [{syn}] [{fin}]\n")
+    packet_log(log, 'RECV', sequence_number, ack_number, ack, syn, fin, payload, peer)
 
     return sequence_number, ack_number, ack, syn, fin, payload
 
-# receive packet
-def receive_packet(s):
-    # receive header and payload
-    header_data, addr = s.recvfrom(12)
-    payload_data, _ = s.recvfrom(32)
 
-    return header_data, payload_data, addr
+# send SYN until the matching SYN|ACK arrives, backing off the timeout after every loss.
+# Returns the SYN|ACK and the payload options (wire.VARLEN, wire.COMPRESSED) the server accepted.
+def handshake(s, receiver, seq_num, rtt, log, legacy=False, retries=8, say=print, varlen=False, compress=False):
+    for attempt in range(retries):
+        header_data, payload_data = create_packet(log, sequence_number=seq_num, syn=1, varlen=varlen, compress=compress)
+        sent_at = time.monotonic()
+        wire.send_packet(s, header_data, payload_data, legacy=legacy)
+        say('Sent SYN')
+        s.settimeout(rtt.rto)
+        try:
+            while True:
+                header_data, payload_data, _ = receiver.receive()
+                try:
+                    packet = unpack_packet(log, header_data, payload_data)
+                except ValueError as e:
+                    message_log(log, f'Dropping malformed packet: {e}\n')
+                    continue
+                ser_ack_num, ser_ack, ser_syn = packet[1:4]
+                if ser_syn and ser_ack and ser_ack_num == seq_num + 1:
+                    options = wire.options(header_data)
+                    break
+        except socket.timeout:
+            rtt.backoff()
+            continue
+        finally:
+            s.settimeout(None)
+        if attempt == 0: # Karn's rule, a retransmitted SYN gives no usable sample
+            rtt.sample(time.monotonic() - sent_at)
+        return packet, options
+    raise TimeoutError('No SYN|ACK from server')
+
+# handle one incoming packet (waiting at most timeout seconds) and fire due retransmissions
+def pump(s, receiver, sender, timeout, log):
+    s.settimeout(timeout)
+    try:
+        header_data, payload_data, _ = receiver.receive()
+    except (socket.timeout, BlockingIOError):
+        sender.check_timers()
+        return None
+    finally:
+        s.settimeout(None)
+    try:
+        packet = unpack_packet(log, header_data, payload_data)
+    except ValueError as e:
+        # one bad datagram is dropped like a lost one, the session carries on
+        message_log(log, f'Dropping malformed packet: {e}\n')
+        sender.check_timers()
+        return None
+    if packet[2]:
+        sender.ack_received(packet[1])
+    sender.check_timers()
+    return packet
 
+# wait until everything sent so far has been acknowledged
+def drain(s, receiver, sender, log, on_packet=None):
+    while not sender.idle():
+        packet = pump(s, receiver, sender, sender.timeout(), log)
+        if packet is not None and on_packet is not None:
+            on_packet(packet)
+
+# one client session: handshake, configuration, --motion-events motion updates, FIN.
+# Returns (edge to send latencies, retransmissions).
+def run(args, GPIO, log, say=print):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        # connect to server
+        s.connect((args.server, args.port))
+        receiver = wire.PacketReceiver(s)
+        SEQ_NUM = random.randint(0, 100)
+        if args.loss or args.delay:
+            # testing: drop/delay our own datagrams to exercise retransmission
+            s = reliable.LossyTransport(s, args.loss, args.delay, args.delay / 2)
+        rtt = reliable.RttEstimator()
+        
+        # send SYN, receive SYN|ACK; variable length payloads (and compression) if the server takes them
+        offer_varlen = not args.legacy and not args.fixed_payload
+        packet, options = handshake(s, receiver, SEQ_NUM, rtt, log, args.legacy, say=say,
+                                    varlen=offer_varlen, compress=offer_varlen and args.compress)
+        ser_seq_num, ser_ack_num, ser_ack, ser_syn, ser_fin, payload = packet
+        say('SYN|ACK Received')
+        payload_format = {'varlen': bool(options & wire.VARLEN), 'compress': bool(options & wire.COMPRESSED)}
+        
+        # send ACK
+        header_data, payload_data = create_packet(log, sequence_number=ser_ack_num, ack_number=ser_seq_num + 1, ack=1, **payload_format)
+        wire.send_packet(s, header_data, payload_data, legacy=args.legacy)
+        say('Sent ACK')
+        
+        # from here on every message goes through the sliding window and is retransmitted until ACKed
+        def transmit(seq, fields):
+            header_data, payload_data = create_packet(log, sequence_number=seq, ack_number=ser_seq_num + 1, **payload_format, **fields)
+            wire.send_packet(s, header_data, payload_data, legacy=args.legacy)
+        sender = reliable.Sender(transmit, ser_ack_num, window=args.window, rtt=rtt)
+        
+        # Send duration and blinks
+        sender.send(payload='Duration: 1, Blinks: 5')
+        say('Sent Duration and Blinks')
+        
+        # receive ACK for duration and blinks - logs payload
+        def log_ack_payload(packet):
+            if packet[5]:
+                message_log(log, packet[5] + '\n')
+                say(packet[5])
+        drain(s, receiver, sender, log, log_ack_payload)
+        say('ACK Received')
+        
+        # motion edges wake the same select() as incoming ACKs and are sent right away,
+        # up to --window motion updates can be in flight at once
+        sensor = pir.MotionSensor(GPIO, PIN, debounce=args.debounce)
+        selector = selectors.DefaultSelector()
+        selector.register(s, selectors.EVENT_READ)
+        selector.register(sensor, selectors.EVENT_READ)
+        latencies = []
+        detected = 0
+        # timed when the update actually goes out, which includes waiting for room in the window
+        def motion_sent(event):
+            latency = event.latency()
+            latencies.append(latency)
+            message_log(log, f'Motion edge to send: {latency * 1e6:.0f}us\n')
+        while detected < args.motion_events:
+            for key, _ in selector.select(sender.timeout()):
+                if key.fileobj is sensor:
+                    for event in sensor.pop_events():
+                        if detected == args.motion_events:
+                            break
+                        
+                        # create packet for detected motion
+                        sender.send(on_sent=lambda event=event: motion_sent(event), payload=':MotionDetected')
+                        say("Sending motion update")
+                        detected += 1
+                else:
+                    # pick up ACKs that arrived in the meantime
+                    pump(s, receiver, sender, 0, log)
+            sender.check_timers()
+        selector.close()
+        sensor.close()
+                
+        # receive ACKs for the motion updates
+        drain(s, receiver, sender, log)
+        say('ACK Received')
+        if latencies:
+            latencies.sort()
+            say(f'Edge to send latency: min {latencies[0] * 1e6:.0f}us, '
+                f'median {latencies[len(latencies) // 2] * 1e6:.0f}us, max {latencies[-1] * 1e6:.0f}us'
+                + (f' ({sensor.suppressed} bounces ignored)' if sensor.suppressed else ''))
+                
+        # send FIN
+        sender.send(fin=1)
+        say("Send FIN")
+        drain(s, receiver, sender, log)
+        if sender.retransmissions:
+            say(f'Retransmissions: {sender.retransmissions}, RTO: {rtt.rto:.3f}s')
+        return latencies, sender.retransmissions
+
+# --sensors N: N simulated sensors, each with its own session, from this one process
+def run_sensors(args, log):
+    results = []
+    errors = []
+    def sensor(index):
+        GPIO = gpio.load(gpio.SIMULATED, args.pir_rate, seed=index)
+        GPIO.setmode(GPIO.BOARD)
+        try:
+            results.append(run(args, GPIO, log, say=lambda *values: None))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            GPIO.cleanup()
+    started = time.monotonic()
+    threads = [threading.Thread(target=sensor, args=(index,), daemon=True) for index in range(args.sensors)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(latency for session, _ in results for latency in session)
+    print(f'{len(results)}/{args.sensors} sessions completed in {elapsed:.2f}s, '
+          f'{len(latencies)} motion updates, {sum(retransmissions for _, retransmissions in results)} retransmissions')
+    if latencies:
+        print(f'Edge to send latency: median {latencies[len(latencies) // 2] * 1e6:.0f}us, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f}us, max {latencies[-1] * 1e6:.0f}us')
+    for e in errors[:5]:
+        print(f'Session failed: {e}')
+    if errors:
+        raise RuntimeError(f'{len(errors)} of {args.sensors} sessions failed')
 
 if __name__ == '__main__':
+    import argparse
+
     # parse arguments
     args = argparse.ArgumentParser(description="Server for receiving packets")
     args.add_argument("-s", "--server", type=str, default='localhost', help='Server IP')
     args.add_argument("-p", "--port", type=int, default=12345, help='Server port')
     args.add_argument("-l", "--logfile", type=str, default='client_log.txt', help='Log file location')
+    args.add_argument("--log-format", choices=('text', 'binary'), default='text', help='Log text lines or binary records (query with common/binlog.py)')
+    args.add_argument("--legacy", action='store_true', help='Send header and payload as two datagrams (original framing)')
+    args.add_argument("--fixed-payload", action='store_true', help='Do not offer variable length payloads (always pad to 32 bytes)')
+    args.add_argument("--compress", action='store_true', help='Offer zlib compression of long payloads')
+    args.add_argument("-w", "--window", type=int, default=4, help='Messages that may be in flight before waiting for ACKs')
+    args.add_argument("-m", "--motion-events", type=int, default=1, help='Motion updates to send before FIN')
+    args.add_argument("--debounce", type=float, default=0.5, help='Ignore PIR edges closer together than this (seconds)')
+    args.add_argument("--gpio", choices=gpio.BACKENDS, default=gpio.RPI, help='GPIO backend: RPi.GPIO or simulated in memory')
+    args.add_argument("--pir-rate", type=float, default=1.0, help='Simulated GPIO: PIR edges per second')
+    args.add_argument("-n", "--sensors", type=int, default=1, help='Simulated GPIO: virtual sensors to run, one session each')
+    args.add_argument("--loss", type=float, default=0.0, help='Testing: probability of dropping an outgoing datagram')
+    args.add_argument("--delay", type=float, default=0.0, help='Testing: delay added to outgoing datagrams (seconds)')
     args = args.parse_args()
+    if args.sensors > 1 and args.gpio != gpio.SIMULATED:
+        print('--sensors needs --gpio sim')
+        exit(2)
     
-    logfile = args.logfile
+    log = open_log(args.logfile, args.log_format)
     
     # GPIO code
-    PIN = 32
+    GPIO = gpio.load(args.gpio, args.pir_rate)
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BOARD)
-    GPIO.setup(PIN,GPIO.IN)
     
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            # connect to server
-            s.connect((args.server, args.port))
-            SEQ_NUM = random.randint(0, 100)
-            
-            # send SYN
-            header_data, payload_data = create_packet(sequence_number=SEQ_NUM, syn=1)
-            s.send(header_data)
-            s.send(payload_data)
-            print('Sent SYN')
-            
-            # receive SYN|ACK
-            header_data, payload_data, _ = receive_packet(s)
-            ser_seq_num, ser_ack_num, ser_ack, ser_syn, ser_fin, payload = unpack_packet(header_data, payload_data)
-            print('SYN|ACK Received')
-            
-            # send ACK
-            header_data, payload_data = create_packet(sequence_number=ser_ack_num, ack_number=ser_seq_num + 1, ack=1)
-            s.send(header_data)
-            s.send(payload_data)
-            print('Sent ACK')
-            
-            # Send duration and blinks
-            header_data, payload_data = create_packet(sequence_number=ser_ack_num, ack_number=ser_seq_num + 1, payload='Duration: 1, Blinks: 5')
-            s.send(header_data)
-            s.send(payload_data)
-            print('Sent Duration and Blinks')
-            
-            # receive ACK for duration and blinks - logs payload
-            header_data, payload_data, _ = receive_packet(s)
-            ser_seq_num, ser_ack_num, ser_ack, ser_syn, ser_fin, payload = unpack_packet(header_data, payload_data)
-            message_log(logfile, payload + '\n')
-            print(payload)
-            print('ACK Received')
-            
-            # listen for motion detected
-            listening = 1
-            while listening:
-                time.sleep(0.1)
-                current_state = GPIO.input(PIN)
-                if current_state == 1:
-                    
-                    # create packet for detected motion
-                    header_data, payload_data = create_packet(sequence_number=ser_ack_num, ack_number=ser_seq_num + 1, payload=':MotionDetected')
-                    s.send(header_data)
-                    s.send(payload_data)
-                    print("Sending motion update")
-
-                    # receive ACK for duration and number of blinks
-                    header_data, payload_data, _ = receive_packet(s)
-                    ser_seq_num, ser_ack_num, ser_ack, ser_syn, ser_fin, payload = unpack_packet(header_data, payload_data)
-                    print('ACK Received')
-                    listening = 0
-                    
-            # send FIN
-            header_data, payload_data = create_packet(sequence_number=ser_ack_num, ack_number=ser_seq_num + 1, fin=1)
-            s.send(header_data)
-            s.send(payload_data)
-            print("Send FIN")
-           
+        if args.sensors == 1:
+            run(args, GPIO, log)
+        else:
+            run_sensors(args, log)
     except KeyboardInterrupt:
         print("\nExiting program.")
     except Exception as e:
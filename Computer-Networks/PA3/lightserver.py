@@ -1,22 +1,71 @@
-import argparse
+import os
+import random
 import socket
 import struct
-import random
+import sys
 import time
-import re
-from datetime import datetime
-import RPi.GPIO as GPIO
+import selectors
+
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import admission
+from common import asynclog
+from common import binlog
+from common import metrics
+from PA3 import gpio
+from PA3 import reliable
+from PA3 import scheduler
+from PA3 import wire
 
 HEADER_FORMAT = '>III'
 
+# sessions that have not sent anything for this long are dropped from the connection table
+SESSION_TIMEOUT = 60
+# sessions that never finished the handshake are dropped much sooner, so a SYN flood cannot fill the table
+HANDSHAKE_TIMEOUT = 5
+
+# board pin of the LED
+PIN = 16
+
+# session states, advanced by Session.handle
+SYN_RECEIVED = 'SYN_RECEIVED'
+ESTABLISHED = 'ESTABLISHED'
+CONFIGURED = 'CONFIGURED'
+CLOSED = 'CLOSED'
+
+# served on --metrics-port
+PACKETS_IN = metrics.counter('pa3_packets_received', 'Datagrams received')
+PACKETS_OUT = metrics.counter('pa3_packets_sent', 'Packets sent')
+BYTES_IN = metrics.counter('pa3_bytes_received', 'Bytes of received datagrams')
+BYTES_OUT = metrics.counter('pa3_bytes_sent', 'Bytes of sent packets')
+PACKET_ERRORS = metrics.counter('pa3_packet_errors', 'Datagrams that could not be parsed or handled')
+HANDSHAKE_SECONDS = metrics.histogram('pa3_handshake_seconds', 'Time from a new SYN to the session being established')
+HANDLE_SECONDS = metrics.histogram('pa3_handle_seconds', 'Time to handle one received datagram')
+RATE_LIMITED = metrics.counter('pa3_rate_limited', 'Datagrams dropped for going over the rate limit')
+REJECTED_SESSIONS = metrics.counter('pa3_rejected_sessions', 'New clients dropped because the connection table was full')
+
+# text lines, or with log_format 'binary' structured records (see common/binlog.py); queued,
+# written and timestamped by a background thread
+def open_log(logfile, log_format='text'):
+    if log_format == 'binary':
+        return binlog.get_logger(logfile)
+    return asynclog.get_logger(logfile)
+
 # for message logging
-def message_log(logfile, message):
-    timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    with open(logfile, 'a') as log_file:
-        log_file.write(f"[{timestamp}] {message}")
+def message_log(log, message):
+    log.log(message)
+
+# one SEND/RECV line per packet
+def packet_log(log, direction, sequence_number, ack_number, ack, syn, fin, payload=None, peer=None):
+    if log.binary:
+        log.packet(binlog.SEND if direction == 'SEND' else binlog.RECV, sequence_number, ack_number,
+                   (ack << 2) | (syn << 1) | fin, peer=peer, text=payload or None)
+    else:
+        message_log(log, f"\"{direction}\" <{sequence_number}> <{ack_number}> [{ack}] [{syn}] [{fin}]\n")
         
 # create packet from parameters
-def create_packet(**kwargs):
+def create_packet(log, **kwargs):
     # get values from parameters
     sequence_number = kwargs.get('sequence_number', 0)
     ack_number = kwargs.get('ack_number', 0)
@@ -24,6 +73,10 @@ def create_packet(**kwargs):
     ack = kwargs.get('ack', 0)
     syn = kwargs.get('syn', 0)
     fin = kwargs.get('fin', 0)
+    peer = kwargs.get('peer')
+    # payload format negotiated by the handshake (see wire.py)
+    varlen = kwargs.get('varlen', False)
+    compress = kwargs.get('compress', False)
 
     # get flag values
     flags = 0
@@ -32,51 +85,281 @@ def create_packet(**kwargs):
     flags |= fin
 
     # pack header and payload
-    header_data = struct.pack(HEADER_FORMAT, sequence_number, ack_number, flags)
-    payload_data = payload.encode('utf-8').ljust(32, b'\x00')
+    options, payload_data = wire.pack_payload(payload.encode('utf-8'), syn, varlen, compress)
+    header_data = struct.pack(HEADER_FORMAT, sequence_number, ack_number, flags | options)
         
-    message_log(logfile, f"\"SEND\" <{sequence_number}> <{ack_number}> [{ack}] [{syn}] [{fin}]\n")
+    packet_log(log, 'SEND', sequence_number, ack_number, ack, syn, fin, payload.rstrip('\x00'), peer)
 
     return header_data, payload_data
 
 # unpack packet information
-def unpack_packet(header_data, payload_data):
+def unpack_packet(log, header_data, payload_data, peer=None):
     # unpack header
     sequence_number, ack_number, flags = struct.unpack(HEADER_FORMAT, header_data)
+    # receive and decode payload (fixed 32 bytes or length prefixed, by the flags)
+    payload = str(wire.unpack_payload(flags, payload_data), 'utf-8').rstrip('\x00')
     # extract flag bits
     flags = flags & 0b111
     ack = (flags >> 2) & 0b1
     syn = (flags >> 1) & 0b1
     fin = flags & 0b1
-    # receive and decode payload
-    payload = payload_data.decode('utf-8').rstrip('\x00')
-    message_log(logfile, f"\"RECV\" <{sequence_number}> <{ack_number}> [{ack}] [{syn}] [{fin}]\n")
+    packet_log(log, 'RECV', sequence_number, ack_number, ack, syn, fin, payload, peer)
 
     return sequence_number, ack_number, ack, syn, fin, payload
 
-# receive packet
-def receive_packet(s):
-    # receive header and payload
-    header_data, addr = s.recvfrom(12)
-    payload_data, _ = s.recvfrom(32)
+# the whole numbers in a text, e.g. 'Duration: 1, Blinks: 5' -> [1, 5]
+def parse_numbers(text):
+    words = ''.join(c if c.isalnum() else ' ' for c in text).split()
+    return [int(word) for word in words if word.isdecimal()]
+
+# one client in the server's connection table, keyed by its (addr, port). server is the
+# 'host:port' it talks to, pin the LED it blinks, isn its initial sequence number (None picks
+# a random one).
+class Session:
+    def __init__(self, outbox, leds, address, log, server, pin=PIN, isn=None):
+        self.outbox = outbox
+        self.leds = leds
+        self.address = address
+        self.log = log
+        self.server = server
+        self.pin = pin
+        self.state = None
+        self.seq_num = random.randint(0, 100) if isn is None else isn
+        self.legacy = False # peer uses two datagram framing, answer the same way
+        self.options = 0 # option bits of the packet being handled
+        self.varlen = False # payload format agreed on in the handshake
+        self.compress = False
+        self.header_data = None # first datagram of a legacy header/payload pair
+        self.receiver = None # in-order delivery of the client's data messages, set up by SYN
+        self.last_ack = None # repeated when a duplicate shows the client missed it
+        self.duration = None
+        self.blinks = None
+        self.last_seen = time.monotonic()
+        self.syn_received_at = None
+
+    def send(self, **kwargs):
+        header_data, payload_data = create_packet(self.log, sequence_number=self.seq_num, peer=self.address,
+                                                  varlen=self.varlen, compress=self.compress, **kwargs)
+        self.outbox.add(header_data, payload_data, self.address, self.legacy)
+        PACKETS_OUT.inc()
+        BYTES_OUT.inc(len(header_data) + len(payload_data))
+
+    def established(self):
+        self.state = ESTABLISHED
+        HANDSHAKE_SECONDS.observe(time.perf_counter() - self.syn_received_at)
+
+    # data is a view into the server's receive buffer, only valid during this call
+    def datagram_received(self, data):
+        self.last_seen = time.monotonic()
+        if len(data) == wire.HEADER_SIZE:
+            # legacy framing: keep the header until its payload datagram arrives
+            self.legacy = True
+            self.header_data = bytes(data)
+        elif self.header_data is not None:
+            header_data, self.header_data = self.header_data, None
+            self.packet_received(header_data, data[:wire.PAYLOAD_SIZE])
+        elif len(data) >= wire.PACKET_SIZE or wire.is_varlen(data):
+            self.packet_received(data[:wire.HEADER_SIZE], data[wire.HEADER_SIZE:])
+
+    def packet_received(self, header_data, payload_data):
+        self.options = wire.options(header_data)
+        try:
+            packet = unpack_packet(self.log, header_data, payload_data, self.address)
+        except ValueError as x:
+            # dropped like a lost datagram, the session keeps going
+            PACKET_ERRORS.inc()
+            message_log(self.log, f"Dropping malformed packet from {self.address}: {x}\n")
+            return
+        self.handle(*packet)
+
+    # cumulative ACK for everything up to and including seq
+    def acknowledge(self, seq, payload=None):
+        self.last_ack = {'ack_number': seq + 1, 'ack': 1}
+        if payload is not None:
+            self.last_ack['payload'] = payload
+        self.send(**self.last_ack)
 
-    return header_data, payload_data, addr
+    # called by the LED scheduler after every blink
+    def blinked(self, cl_seq_num):
+        print('Blinking')
+        # send ACK
+        self.acknowledge(cl_seq_num)
+        print("Sent ACK")
 
+    # state machine: SYN -> SYN_RECEIVED -> ACK -> ESTABLISHED -> config -> CONFIGURED -> motion* -> FIN -> CLOSED
+    def handle(self, cl_seq_num, cl_ack_num, cl_ack, cl_syn, cl_fin, payload):
+        if cl_syn:
+            if self.state is None:
+                print(f"SYN Recieved from {self.address}")
+                self.receiver = reliable.Receiver(cl_seq_num + 1)
+                self.state = SYN_RECEIVED
+                # accept the payload formats the client offers (never for two datagram framing)
+                self.varlen = bool(self.options & wire.VARLEN) and not self.legacy
+                self.compress = self.varlen and bool(self.options & wire.COMPRESSED)
+                self.syn_received_at = time.perf_counter()
+            if self.state == SYN_RECEIVED: # also answers a retransmitted SYN whose SYN|ACK was lost
+                # send ACK|SYN
+                self.send(ack_number=cl_seq_num + 1, syn=1, ack=1)
+                print("Sending ACK|SYN")
+            return
+
+        if not payload and not cl_fin:
+            # pure ACK, does not use a sequence number
+            if self.state == SYN_RECEIVED and cl_ack:
+                print("ACK Received")
+                self.established()
+            return
+
+        if self.receiver is None:
+            if cl_fin: # retransmitted FIN of a session that is already gone
+                self.acknowledge(cl_seq_num)
+                self.state = CLOSED
+            else:
+                message_log(self.log, f"Unexpected packet from {self.address} without a handshake: {payload}\n")
+            return
+
+        delivered = self.receiver.receive(cl_seq_num, (cl_seq_num, cl_fin, payload))
+        if not delivered:
+            # duplicate or out of order: repeat the last ACK so the client learns what arrived
+            if self.last_ack is not None:
+                self.send(**self.last_ack)
+            return
+
+        for cl_seq_num, cl_fin, payload in delivered:
+            self.deliver(cl_seq_num, cl_fin, payload)
+
+    # one data message, in order and exactly once
+    def deliver(self, cl_seq_num, cl_fin, payload):
+        if cl_fin:
+            message_log(self.log, f":Interaction with server ({self.server}) completed\n")
+            print(f"FIN Received from {self.address}\n")
+            self.acknowledge(cl_seq_num)
+            self.state = CLOSED
+
+        elif self.state in (SYN_RECEIVED, ESTABLISHED):
+            # receive duration and number of blinks (a lost handshake ACK is implied by the data)
+            if self.state == SYN_RECEIVED:
+                self.established()
+            self.duration, self.blinks = parse_numbers(payload)
+            message_log(self.log, f'Duration: {self.duration}, Blinks: {self.blinks}\n')
+            print(f'Duration: {self.duration}, Blinks: {self.blinks}')
+
+            # send ACK for duration and blinks
+            self.acknowledge(cl_seq_num, f'Duration: {self.duration} Blinks: {self.blinks}')
+            print("Sent ACK")
+            self.state = CONFIGURED
+
+        elif self.state == CONFIGURED and payload == ':MotionDetected':
+            # process payload for detected motion, ACK receipt right away so the client does not retransmit
+            message_log(self.log, f"Payload: {payload}\n")
+            self.acknowledge(cl_seq_num)
+            # blink LED on the scheduler, the event loop keeps serving other sessions meanwhile
+            if not self.leds.blink(self.pin, self.duration, self.blinks, lambda: self.blinked(cl_seq_num)):
+                print('LED already blinking, joined the running sequence')
+
+        else:
+            message_log(self.log, f"Unexpected packet from {self.address} in state {self.state}: {payload}\n")
+            self.acknowledge(cl_seq_num)
+
+# event loop serving every client from one socket, blinking pin on GPIO and logging to log.
+# limiter drops datagrams over the per-host/total rate before they are parsed, max_sessions
+# bounds the connection table, isn fixes every session's initial sequence number (testing)
+def serve(s, log, GPIO, pin=PIN, out=None, limiter=None, max_sessions=None, isn=None):
+    sessions = {}
+    timers = scheduler.Scheduler()
+    leds = scheduler.LedScheduler(timers, GPIO)
+    server = '%s:%s' % s.getsockname()[:2]
+    outbox = wire.Outbox(out or s) # replies of one loop pass go out in a single sendmmsg batch
+    receive_buffer = memoryview(bytearray(2048))
+    s.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(s, selectors.EVENT_READ)
+    metrics.gauge('pa3_sessions', 'Sessions in the connection table', lambda: len(sessions))
+
+    while True:
+        # sleep in select() only until the next blink step is due
+        timeout = timers.timeout()
+        for key, events in selector.select(timeout=1 if timeout is None else min(timeout, 1)):
+            # drain every queued datagram before going back to select()
+            while True:
+                try:
+                    nbytes, address = s.recvfrom_into(receive_buffer)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except socket.error:
+                    continue # e.g. ICMP port unreachable from a client that went away
+
+                PACKETS_IN.inc()
+                BYTES_IN.inc(nbytes)
+                if limiter is not None and not limiter.allow(address[0]):
+                    RATE_LIMITED.inc()
+                    continue
+                started = time.perf_counter()
+                try:
+                    if address[1] < 1024 or address[1] > 65535:
+                        raise Exception(f'ERROR: wrong port number: {address[1]}... Dropping packet')
+                    session = sessions.get(address)
+                    if session is None:
+                        if max_sessions is not None and len(sessions) >= max_sessions:
+                            REJECTED_SESSIONS.inc()
+                            continue
+                        session = sessions[address] = Session(outbox, leds, address, log, server, pin, isn)
+                    session.datagram_received(receive_buffer[:nbytes])
+                    if session.state == CLOSED:
+                        del sessions[address]
+                # a broken session must not take the others down
+                except Exception as x:
+                    PACKET_ERRORS.inc()
+                    print(f"Error: {x}")
+                    message_log(log, f"Error: {x}\n")
+                    sessions.pop(address, None)
+                HANDLE_SECONDS.observe(time.perf_counter() - started)
+
+        # blink steps that are due, their ACKs join this pass's batch
+        try:
+            timers.run_due()
+        except Exception as x:
+            print(f"Error: {x}")
+            message_log(log, f"Error: {x}\n")
+        try:
+            outbox.flush()
+        except socket.error as e:
+            message_log(log, f"Error sending replies: {e}\n")
+
+        # forget clients that went quiet without a FIN
+        now = time.monotonic()
+        for address in [address for address, session in sessions.items()
+                        if now - session.last_seen > (HANDSHAKE_TIMEOUT if session.state in (None, SYN_RECEIVED) else SESSION_TIMEOUT)]:
+            message_log(log, f"Session {address} timed out\n")
+            del sessions[address]
 
 if __name__ == '__main__':
+    import argparse
+
     # parse arguments
     args = argparse.ArgumentParser(description="Server for receiving packets")
     args.add_argument("-p", "--port", type=int, default=12345, help='Server port')
     args.add_argument("-l", "--logfile", type=str, default='server_log.txt', help='Log file location')
+    args.add_argument("--log-format", choices=('text', 'binary'), default='text', help='Log text lines or binary records (query with common/binlog.py)')
+    args.add_argument("--gpio", choices=gpio.BACKENDS, default=gpio.RPI, help='GPIO backend: RPi.GPIO or simulated in memory')
+    args.add_argument("--isn", type=int, help='Testing: fixed initial sequence number for every session (for replaying captures)')
+    args.add_argument("--metrics-port", type=int, help='Serve Prometheus metrics on this loopback port')
+    args.add_argument("--max-sessions", type=int, help='Ignore new clients while this many sessions are open')
+    args.add_argument("--rate", type=float, help='Datagrams per second accepted from one client host, the rest are dropped')
+    args.add_argument("--total-rate", type=float, help='Datagrams per second accepted from all clients')
+    args.add_argument("--burst", type=float, help='Datagrams a client may send at once above its rate (default: one second worth)')
+    args.add_argument("--loss", type=float, default=0.0, help='Testing: probability of dropping an outgoing datagram')
+    args.add_argument("--delay", type=float, default=0.0, help='Testing: delay added to outgoing datagrams (seconds)')
     args = args.parse_args()
     
     host = 'localhost'
     port = args.port
-    logfile = args.logfile
-    SEQ_NUM = random.randint(0, 100)
+    log = open_log(args.logfile, args.log_format)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
     
     # GPIO code
-    PIN = 16
+    GPIO = gpio.load(args.gpio)
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BOARD)
     GPIO.setup(PIN,GPIO.OUT, initial=GPIO.LOW)
@@ -85,80 +368,14 @@ if __name__ == '__main__':
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
                 s.bind((host, port))
-                message_log(logfile, f"Server listening on {host}:{port}\n")
+                message_log(log, f"Server listening on {host}:{port}\n")
                 print('Server listening on', host, ':', port, '\n')
-                
-                while True:
-                    try:
-                        # receive SYN
-                        header_data, payload_data, ADDRESS = receive_packet(s)
-                        if ADDRESS[1] < 1024 or ADDRESS[1] > 65535:
-                            raise Exception(f'ERROR: wrong port number: {ADDRESS[1]}... Exiting')
-                        cl_seq_num, cl_ack_num, cl_ack, cl_syn, cl_fin, payload = unpack_packet(header_data, payload_data)
-                        print("SYN Recieved")
-                        
-                        # send ACK|SYN
-                        header_data, payload_data = create_packet(sequence_number=SEQ_NUM, ack_number=cl_seq_num+1, syn=1, ack=1)
-                        s.sendto(header_data, ADDRESS)
-                        s.sendto(payload_data, ADDRESS)
-                        print("Sending ACK|SYN")
-                        
-                        # receive ACK
-                        header_data, payload_data, _ = receive_packet(s)
-                        cl_seq_num, cl_ack_num, cl_ack, cl_syn, cl_fin, payload = unpack_packet(header_data, payload_data)
-                        print("ACK Received")
-                        
-                        # receive duration and number of blinks
-                        header_data, payload_data, _ = receive_packet(s)
-                        cl_seq_num, cl_ack_num, cl_ack, cl_syn, cl_fin, payload = unpack_packet(header_data, payload_data)
-                        duration, blinks = [int(match.group()) for match in re.finditer(r'\b\d+\b', payload)]
-                        message_log(logfile, f'Duration: {duration}, Blinks: {blinks}\n')
-                        print(f'Duration: {duration}, Blinks: {blinks}')
-                        
-                        # send ACK for duration and blinks
-                        header_data, payload_data = create_packet(sequence_number=SEQ_NUM, ack_number=cl_seq_num + 1, ack=1, payload=f'Duration: {duration} Blinks: {blinks}')
-                        s.sendto(header_data, ADDRESS)
-                        s.sendto(payload_data, ADDRESS)
-                        print("Sent ACK")
-                        
-                        # get payload for when motion is detected
-                        header_data, payload_data, _ = receive_packet(s)
-                        cl_seq_num, cl_ack_num, cl_ack, cl_syn, cl_fin, payload = unpack_packet(header_data, payload_data)
-                        
-                        # process payload for detected motion
-                        if payload == ':MotionDetected':
-                            message_log(logfile, f"Payload: {payload}\n")
-                            i = 0
-                            while i < blinks: # blink LED
-                                time.sleep(0.1)
-                                print('Blinking')
-                                GPIO.output(PIN, GPIO.HIGH)
-                                time.sleep(duration)
-                                GPIO.output(PIN, GPIO.LOW)
-                                time.sleep(1)
-                                
-                                # send ACK
-                                header_data, payload_data = create_packet(sequence_number=SEQ_NUM, ack_number=cl_seq_num + 1, ack=1)
-                                s.sendto(header_data, ADDRESS)
-                                s.sendto(payload_data, ADDRESS)
-                                print("Sent ACK")
-                                
-                                i += 1
-                                
-                        # receive FIN
-                        header_data, payload_data, _ = receive_packet(s)
-                        cl_seq, cl_ack, cl_ack, cl_syn, cl_fin, payload = unpack_packet(header_data, payload_data)
-                        message_log(logfile, f":Interaction with server ({host}:{port}) completed\n")
-                        print("FIN Received\n")
-                    # if socket is closed, just keep listening for connections without closing server
-                    except socket.error as e:
-                        continue
-                    except Exception as x:
-                        print(f"Error: {x}")
-                        message_log(logfile, f"Error: {x}\n")
-                        continue
+                # testing: drop/delay replies to exercise the clients' retransmissions
+                out = reliable.LossyTransport(s, args.loss, args.delay, args.delay / 2) if args.loss or args.delay else None
+                limiter = admission.RateLimiter(args.rate, args.total_rate, args.burst) if args.rate or args.total_rate else None
+                serve(s, log, GPIO, PIN, out, limiter, args.max_sessions, args.isn)
                      
         except Exception as fatal_error:
             print(f"Critical error: {fatal_error}")
-            message_log(logfile, f"Critical error: {fatal_error}\n")
+            message_log(log, f"Critical error: {fatal_error}\n")
             exit(1)
\ No newline at end of file
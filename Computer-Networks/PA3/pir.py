@@ -0,0 +1,74 @@
+import os
+import queue
+import threading
+import time
+
+# Edge-triggered PIR input. The GPIO backend calls back on every rising edge (an interrupt on
+# the Pi, the edge thread of gpio.SimulatedGPIO); debounced events go on a queue and a byte is
+# written to a pipe, so a select() loop wakes up the moment motion is seen instead of polling.
+
+class MotionEvent:
+    def __init__(self, pin, edge_time):
+        self.pin = pin
+        self.edge_time = edge_time # time.perf_counter() when the edge was seen
+
+    # seconds from the sensor edge until now (call right after the datagram went out)
+    def latency(self):
+        return time.perf_counter() - self.edge_time
+
+class MotionSensor:
+    def __init__(self, gpio, pin, debounce=0.5):
+        self.gpio = gpio
+        self.pin = pin
+        self.debounce = debounce
+        self.events = queue.Queue()
+        self.suppressed = 0 # edges dropped by the debounce window
+        self._last_edge = None
+        self._wake_read, self._wake_write = os.pipe()
+        self._wake_lock = threading.Lock() # the callback thread writes while close() may run
+        os.set_blocking(self._wake_read, False)
+        gpio.setup(pin, gpio.IN)
+        gpio.add_event_detect(pin, gpio.RISING, callback=self._edge, bouncetime=max(int(debounce * 1000), 1))
+
+    # runs on the GPIO callback thread
+    def _edge(self, channel):
+        now = time.perf_counter()
+        if self._last_edge is not None and now - self._last_edge < self.debounce:
+            self.suppressed += 1
+            return
+        self._last_edge = now
+        self.events.put(MotionEvent(channel, now))
+        with self._wake_lock:
+            if self._wake_write is not None:
+                os.write(self._wake_write, b'\x01')
+
+    # lets the sensor be registered with selectors next to the socket
+    def fileno(self):
+        return self._wake_read
+
+    # every event that is waiting, without blocking
+    def pop_events(self):
+        try:
+            os.read(self._wake_read, 4096)
+        except BlockingIOError:
+            pass
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    # block until the next event (or timeout, returns None)
+    def wait(self, timeout=None):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.gpio.remove_event_detect(self.pin)
+        with self._wake_lock:
+            os.close(self._wake_write)
+            self._wake_write = None
+        os.close(self._wake_read)
@@ -0,0 +1,180 @@
+import random
+import threading
+import time
+from collections import deque
+
+# Reliability on top of the PA3 packets. Every data message (payload or FIN) uses one sequence
+# number; ACKs are cumulative, ack_number = next sequence number the receiver expects.
+
+# retransmission timeout from measured round trips (RFC 6298)
+class RttEstimator:
+    def __init__(self, initial_rto=1.0, min_rto=0.2, max_rto=60.0, granularity=0.01):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.granularity = granularity
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + max(self.granularity, 4 * self.rttvar), self.min_rto), self.max_rto)
+
+    # exponential backoff after a timeout
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.max_rto)
+
+class Segment:
+    def __init__(self, seq, fields, sent_at):
+        self.seq = seq
+        self.fields = fields
+        self.sent_at = sent_at
+        self.retransmitted = False
+
+# sending side: sliding window of unacknowledged messages with a retransmission timer.
+# transmit(seq, fields) puts one packet on the wire; fields are create_packet keyword arguments.
+class Sender:
+    def __init__(self, transmit, next_seq, window=4, rtt=None, max_retries=8, clock=time.monotonic):
+        self.transmit = transmit
+        self.base = next_seq # oldest unacknowledged sequence number
+        self.next_seq = next_seq
+        self.window = window
+        self.rtt = rtt or RttEstimator()
+        self.max_retries = max_retries
+        self.clock = clock
+        self.unacked = deque()
+        self.pending = deque() # messages waiting for room in the window
+        self.deadline = None # retransmission timer of the oldest unacked segment
+        self.retries = 0
+        self.retransmissions = 0
+
+    # on_sent() is called when the message is transmitted the first time, which is later than
+    # send() while the window is full
+    def send(self, on_sent=None, **fields):
+        self.pending.append((fields, on_sent))
+        self._fill()
+
+    def idle(self):
+        return not self.unacked and not self.pending
+
+    def in_flight(self):
+        return len(self.unacked)
+
+    def _fill(self):
+        while self.pending and self.next_seq < self.base + self.window:
+            fields, on_sent = self.pending.popleft()
+            segment = Segment(self.next_seq, fields, self.clock())
+            self.next_seq += 1
+            self.unacked.append(segment)
+            self.transmit(segment.seq, segment.fields)
+            if self.deadline is None:
+                self.deadline = segment.sent_at + self.rtt.rto
+            if on_sent is not None:
+                on_sent()
+
+    # cumulative ACK: everything below ack_number has arrived
+    def ack_received(self, ack_number):
+        if ack_number <= self.base or ack_number > self.next_seq:
+            return False # duplicate or bogus ACK
+        now = self.clock()
+        while self.unacked and self.unacked[0].seq < ack_number:
+            segment = self.unacked.popleft()
+            # Karn's rule: only time segments that were sent exactly once
+            if segment.seq == ack_number - 1 and not segment.retransmitted:
+                self.rtt.sample(now - segment.sent_at)
+        self.base = ack_number
+        self.retries = 0
+        self.deadline = now + self.rtt.rto if self.unacked else None
+        self._fill()
+        return True
+
+    # seconds until the retransmission timer fires, None when nothing is in flight
+    def timeout(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - self.clock(), 0)
+
+    # retransmit the oldest segment if its timer expired
+    def check_timers(self):
+        if self.deadline is None or self.clock() < self.deadline:
+            return
+        if self.retries >= self.max_retries:
+            raise TimeoutError(f'No ACK for sequence number {self.base} after {self.retries} retransmissions')
+        segment = self.unacked[0]
+        segment.retransmitted = True
+        self.retries += 1
+        self.retransmissions += 1
+        self.rtt.backoff()
+        self.transmit(segment.seq, segment.fields)
+        self.deadline = self.clock() + self.rtt.rto
+
+# receiving side: in-order delivery, duplicates dropped, out of order messages held back
+class Receiver:
+    def __init__(self, expected_seq, window=64):
+        self.expected = expected_seq
+        self.window = window
+        self.held = {}
+        self.duplicates = 0
+
+    # ACK number to send back
+    @property
+    def ack_number(self):
+        return self.expected
+
+    # messages that can now be delivered in order ([] for duplicates and gaps)
+    def receive(self, seq, message):
+        if seq < self.expected:
+            self.duplicates += 1
+            return []
+        if seq >= self.expected + self.window:
+            return []
+        self.held[seq] = message
+        delivered = []
+        while self.expected in self.held:
+            delivered.append(self.held.pop(self.expected))
+            self.expected += 1
+        return delivered
+
+# socket wrapper that drops and delays outgoing datagrams, for testing on loopback
+class LossyTransport:
+    def __init__(self, sock, loss=0.0, delay=0.0, jitter=0.0, seed=None):
+        self.sock = sock
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.dropped = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def _deliver(self, send, *args):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        delay = self.delay + self.random.uniform(0, self.jitter)
+        if delay <= 0:
+            send(*args)
+            return
+        timer = threading.Timer(delay, send, args)
+        timer.daemon = True
+        timer.start()
+
+    def send(self, data):
+        self._deliver(self.sock.send, bytes(data))
+        return len(data)
+
+    def sendto(self, data, address):
+        self._deliver(self.sock.sendto, bytes(data), address)
+        return len(data)
+
+    # gathered buffers still make up one datagram, so they are lost or delayed together
+    def sendmsg(self, buffers, *args):
+        data = b''.join(buffers)
+        self._deliver(self.sock.sendmsg, [data], *args)
+        return len(data)
@@ -0,0 +1,118 @@
+import heapq
+import itertools
+import time
+
+# Timers for the server's event loop. Nothing here sleeps: the loop asks timeout() how long
+# it may block in select() and calls run_due() when it wakes up.
+
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._order = itertools.count() # keeps timers with the same deadline in FIFO order
+
+    def __len__(self):
+        return len(self._heap)
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heapq.heappush(self._heap, (when, next(self._order), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    # seconds until the next timer is due, None if there is none
+    def timeout(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - self.clock(), 0)
+
+    # run every timer that is due, returns how many ran
+    def run_due(self):
+        now = self.clock()
+        ran = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self._heap)
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+                ran += 1
+        return ran
+
+# one LED's blink sequence, shared by every motion event that arrives while it runs
+class BlinkTrain:
+    def __init__(self, pin, duration):
+        self.pin = pin
+        self.duration = duration
+        self.subscribers = [] # [blinks still owed, callback after each blink]
+        self.blinks = 0
+
+# runs blink sequences on the scheduler: 0.1s pause, LED on for duration, LED off for 1s,
+# then every subscriber's callback (the per-blink ACK). A motion event for an LED that is
+# already blinking joins the running train instead of starting a second, overlapping one.
+class LedScheduler:
+    def __init__(self, scheduler, gpio, off_time=1, pause=0.1):
+        self.scheduler = scheduler
+        self.gpio = gpio
+        self.off_time = off_time
+        self.pause = pause
+        self.trains = {}
+        self.coalesced = 0
+
+    def blinking(self, pin):
+        return pin in self.trains
+
+    # returns True if a new train was started, False if the event joined a running one
+    def blink(self, pin, duration, blinks, on_blink):
+        if blinks <= 0:
+            return False
+        train = self.trains.get(pin)
+        if train is not None:
+            train.subscribers.append([blinks, on_blink])
+            self.coalesced += 1
+            return False
+        train = self.trains[pin] = BlinkTrain(pin, duration)
+        train.subscribers.append([blinks, on_blink])
+        self.scheduler.call_later(self.pause, self._on, train)
+        return True
+
+    def _on(self, train):
+        self.gpio.output(train.pin, self.gpio.HIGH)
+        self.scheduler.call_later(train.duration, self._off, train)
+
+    def _off(self, train):
+        self.gpio.output(train.pin, self.gpio.LOW)
+        self.scheduler.call_later(self.off_time, self._blinked, train)
+
+    def _blinked(self, train):
+        train.blinks += 1
+        subscribers = train.subscribers
+        for subscriber in subscribers:
+            subscriber[0] -= 1
+        train.subscribers = [subscriber for subscriber in subscribers if subscriber[0] > 0]
+        if train.subscribers:
+            self.scheduler.call_later(self.pause, self._on, train)
+        else:
+            del self.trains[train.pin]
+        # the train is rescheduled first and one failing callback does not cost the others
+        # their ACK; the first error is passed on to run_due's caller afterwards
+        error = None
+        for subscriber in subscribers:
+            try:
+                subscriber[1]()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
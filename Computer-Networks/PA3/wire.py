@@ -0,0 +1,238 @@
+import os
+import socket
+import struct
+import zlib
+
+# PA3 packet on the wire: 12 byte header ('>III' seq, ack, flags) + 32 byte padded payload.
+# Current framing sends both in ONE 44 byte datagram. Legacy framing (the original protocol)
+# sends the header and the payload as two datagrams, 12 then 32 bytes.
+HEADER_SIZE = 12
+PAYLOAD_SIZE = 32
+PACKET_SIZE = HEADER_SIZE + PAYLOAD_SIZE
+
+# Variable length payloads: with VARLEN in the flags the payload is a '>H' length and that
+# many bytes (no padding, an empty ACK is 14 bytes), with COMPRESSED as well the bytes are
+# raw deflate with the preset dictionary ZDICT. SYN and SYN|ACK always use the fixed format;
+# on them the two bits offer (SYN) and accept (SYN|ACK) the formats for the session, so peers
+# that predate them (and mask the flags to 0b111) keep talking fixed 32 byte payloads.
+SYN = 0b10
+VARLEN = 0b1000
+COMPRESSED = 0b10000
+LENGTH = struct.Struct('>H')
+MAX_PAYLOAD = 1024
+MAX_PACKET_SIZE = HEADER_SIZE + LENGTH.size + MAX_PAYLOAD
+# shorter payloads are never worth compressing
+COMPRESS_THRESHOLD = 48
+# the strings every session repeats, most frequent last
+ZDICT = b'Motion edge to send: Payload: Duration: , Blinks: :MotionDetected'
+
+# option bits of a header (offered or accepted formats on a SYN, the payload format otherwise)
+def options(header_data):
+    return struct.unpack_from('>I', header_data, 8)[0] & (VARLEN | COMPRESSED)
+
+# (flag bits, payload_data) for a payload in the session's format
+def pack_payload(payload, syn=0, varlen=False, compress=False):
+    if syn:
+        return (VARLEN if varlen else 0) | (COMPRESSED if compress else 0), payload.ljust(PAYLOAD_SIZE, b'\x00')
+    if not varlen:
+        return 0, payload.ljust(PAYLOAD_SIZE, b'\x00')
+    payload = payload.rstrip(b'\x00')
+    flags = VARLEN
+    if compress and len(payload) >= COMPRESS_THRESHOLD:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=ZDICT)
+        compressed = compressor.compress(payload) + compressor.flush()
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= COMPRESSED
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f'Payload of {len(payload)} bytes, at most {MAX_PAYLOAD} fit in a packet')
+    return flags, LENGTH.pack(len(payload)) + payload
+
+# payload bytes of a packet; data is everything after the header. A malformed payload
+# raises ValueError, whatever went wrong with it.
+def unpack_payload(flags, data):
+    if not flags & VARLEN or flags & SYN:
+        return data[:PAYLOAD_SIZE]
+    if len(data) < LENGTH.size:
+        raise ValueError(f'Truncated payload: {len(data)} bytes, no length')
+    length, = LENGTH.unpack_from(data)
+    if len(data) < LENGTH.size + length:
+        raise ValueError(f'Truncated payload: {len(data) - LENGTH.size} of {length} bytes')
+    payload = data[LENGTH.size:LENGTH.size + length]
+    if flags & COMPRESSED:
+        decompressor = zlib.decompressobj(-15, zdict=ZDICT)
+        try:
+            payload = decompressor.decompress(payload, MAX_PAYLOAD * 16)
+        except zlib.error as e:
+            raise ValueError(f'Compressed payload is corrupt: {e}') from e
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError('Compressed payload is corrupt or expands too far')
+    return payload
+
+# a whole variable length packet in one datagram (as opposed to a legacy header or payload)
+def is_varlen(datagram):
+    if len(datagram) < HEADER_SIZE + LENGTH.size:
+        return False
+    flags = struct.unpack_from('>I', datagram, 8)[0]
+    return bool(flags & VARLEN) and not flags & SYN and \
+        LENGTH.unpack_from(datagram, HEADER_SIZE)[0] == len(datagram) - HEADER_SIZE - LENGTH.size
+
+# send one packet; the header and payload are gathered by sendmsg, not concatenated
+def send_packet(sock, header_data, payload_data, address=None, legacy=False):
+    if legacy:
+        if address is None:
+            sock.send(header_data)
+            sock.send(payload_data)
+        else:
+            sock.sendto(header_data, address)
+            sock.sendto(payload_data, address)
+    elif address is None:
+        sock.sendmsg([header_data, payload_data])
+    else:
+        sock.sendmsg([header_data, payload_data], (), 0, address)
+
+# receive packets into one preallocated buffer with recvfrom_into
+class PacketReceiver:
+    def __init__(self, sock, size=MAX_PACKET_SIZE):
+        self.sock = sock
+        self.buf = bytearray(max(size, PACKET_SIZE))
+        self.view = memoryview(self.buf)
+        self.legacy = False # set once the peer is seen using two datagram framing
+
+    # (header, payload, address) as memoryviews into the buffer, valid until the next receive
+    def receive(self):
+        while True:
+            nbytes, address = self.sock.recvfrom_into(self.view)
+            while nbytes == HEADER_SIZE:
+                # legacy peer: the payload follows in its own datagram
+                self.legacy = True
+                nbytes, _ = self.sock.recvfrom_into(self.view[HEADER_SIZE:])
+                if nbytes == HEADER_SIZE: # payload was lost, this is the next header
+                    self.view[:HEADER_SIZE] = self.view[HEADER_SIZE:2 * HEADER_SIZE]
+                    continue
+                return self.view[:HEADER_SIZE], self.view[HEADER_SIZE:PACKET_SIZE], address
+            if nbytes == PAYLOAD_SIZE and not is_varlen(self.view[:nbytes]): # legacy payload whose header was lost
+                continue
+            return self.view[:HEADER_SIZE], self.view[HEADER_SIZE:nbytes], address
+
+# sendmmsg(2) through ctypes: many datagrams in one system call (Linux, IPv4).
+# Python's socket module has no sendmmsg, so anything else falls back to a sendmsg loop.
+# ctypes is loaded by the first batch rather than on import, and libc is found through the
+# symbols already in the process (ctypes.util.find_library would run ldconfig).
+
+_sendmmsg = None # (ctypes, sendmmsg, iovec, mmsghdr) once loaded, False where unavailable
+
+def _load_sendmmsg():
+    global _sendmmsg
+    if _sendmmsg is not None:
+        return _sendmmsg
+    _sendmmsg = False
+    try:
+        import ctypes
+        sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (ImportError, OSError, AttributeError, TypeError):
+        return _sendmmsg
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+
+    class iovec(ctypes.Structure):
+        _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+    class msghdr(ctypes.Structure):
+        _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                    ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                    ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                    ('msg_flags', ctypes.c_int)]
+
+    class mmsghdr(ctypes.Structure):
+        _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+    _sendmmsg = (ctypes, sendmmsg, iovec, mmsghdr)
+    return _sendmmsg
+
+def _sockaddr_in(address):
+    host, port = address[:2]
+    return struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) + socket.inet_aton(socket.gethostbyname(host)) + bytes(8)
+
+def has_sendmmsg(sock):
+    return isinstance(sock, socket.socket) and sock.family == socket.AF_INET and bool(_load_sendmmsg())
+
+# send many datagrams in one pass. datagrams is a list of bytes objects or (header, payload)
+# pairs, whose parts are gathered into one datagram by the kernel (one iovec each) instead of
+# being joined first; destinations is None for a connected socket, one address, or one address
+# per datagram. Returns the number of sendmmsg/sendmsg system calls made.
+def send_batch(sock, datagrams, destinations=None):
+    if not datagrams:
+        return 0
+    # bytes parts are passed to the kernel in place, other buffers are copied once
+    datagrams = [tuple(part if isinstance(part, bytes) else bytes(part) for part in datagram)
+                 if isinstance(datagram, tuple) else (bytes(datagram),) for datagram in datagrams]
+    if destinations is None or isinstance(destinations, tuple):
+        destinations = [destinations] * len(datagrams)
+
+    if not has_sendmmsg(sock):
+        for parts, address in zip(datagrams, destinations):
+            if address is None:
+                sock.sendmsg(parts)
+            else:
+                sock.sendmsg(parts, (), 0, address)
+        return len(datagrams)
+
+    ctypes, sendmmsg, iovec, mmsghdr = _sendmmsg
+    count = len(datagrams)
+    iovecs = (iovec * sum(len(parts) for parts in datagrams))()
+    messages = (mmsghdr * count)()
+    names = {}
+    index = 0
+    for i, (parts, address) in enumerate(zip(datagrams, destinations)):
+        header = messages[i].msg_hdr
+        header.msg_iov = ctypes.cast(ctypes.addressof(iovecs) + index * ctypes.sizeof(iovec), ctypes.POINTER(iovec))
+        header.msg_iovlen = len(parts)
+        for part in parts:
+            iovecs[index].iov_base = ctypes.cast(ctypes.c_char_p(part), ctypes.c_void_p)
+            iovecs[index].iov_len = len(part)
+            index += 1
+        if address is not None:
+            if address not in names:
+                names[address] = ctypes.create_string_buffer(_sockaddr_in(address), 16)
+            header.msg_name = ctypes.cast(names[address], ctypes.c_void_p)
+            header.msg_namelen = 16
+
+    calls = 0
+    sent = 0
+    while sent < count:
+        result = sendmmsg(sock.fileno(), ctypes.addressof(messages) + sent * ctypes.sizeof(mmsghdr), count - sent, 0)
+        calls += 1
+        if result < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        sent += result
+    return calls
+
+# replies collected during one pass of an event loop, sent together with send_batch
+class Outbox:
+    def __init__(self, sock):
+        self.sock = sock
+        self.datagrams = []
+        self.destinations = []
+
+    def __len__(self):
+        return len(self.datagrams)
+
+    def add(self, header_data, payload_data, address, legacy=False):
+        if legacy:
+            self.datagrams += [header_data, payload_data]
+            self.destinations += [address, address]
+        else:
+            self.datagrams.append((header_data, payload_data))
+            self.destinations.append(address)
+
+    # returns the number of system calls it took
+    def flush(self):
+        if not self.datagrams:
+            return 0
+        try:
+            return send_batch(self.sock, self.datagrams, self.destinations)
+        finally:
+            self.datagrams = []
+            self.destinations = []
@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+# make the shared modules importable when run as a script
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from common import framing
+from PA1 import client as pa1_client
+from PA2 import lightpool
+from PA3 import gpio
+from PA3 import lightclient as pa3_client
+
+# Load generator for the three protocols. -c workers (one thread and one connection/session
+# each) share -n messages and time every one of them:
+#   pa1 - one BBBH packet and its reply
+#   pa2 - one LIGHTON/LIGHTOFF command and its reply on a negotiated (HELLO) connection
+#   pa3 - one whole session: SYN, configuration, --motion-events motion updates, FIN
+# The result is one JSON object: throughput, latency percentiles and CPU per message for the
+# load generator and, when it was started here (--spawn) or named (--server-pid), the server.
+
+PROTOCOLS = ('pa1', 'pa2', 'pa3')
+
+PA2_COMMANDS = ('LIGHTON', 'LIGHTOFF')
+
+def pa1_worker(args, count, record):
+    packet = pa1_client.create_packet(1, 4, args.service_type, args.payload)
+    with socket.create_connection((args.host, args.port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = framing.FrameReader(sock, framing.BBBH)
+        for i in range(args.warmup + count):
+            start = time.perf_counter_ns()
+            sock.sendall(packet)
+            if reader.read_frame() is None:
+                raise ConnectionError('Server closed the connection')
+            if i >= args.warmup:
+                record(time.perf_counter_ns() - start)
+
+def pa2_worker(args, count, record):
+    with lightpool.LightConnection(args.host, args.port) as conn:
+        for i in range(args.warmup + count):
+            start = time.perf_counter_ns()
+            if not conn.command(PA2_COMMANDS[i % 2]):
+                raise RuntimeError(f'Server refused {PA2_COMMANDS[i % 2]}')
+            if i >= args.warmup:
+                record(time.perf_counter_ns() - start)
+
+def pa3_worker(args, count, record):
+    options = SimpleNamespace(server=args.host, port=args.port, legacy=args.legacy, window=args.window,
+                              motion_events=args.motion_events, debounce=0, loss=0.0, delay=0.0,
+                              fixed_payload=False, compress=False)
+    log = pa3_client.open_log(args.client_log)
+    for i in range(args.warmup + count):
+        sensor = gpio.load(gpio.SIMULATED, args.pir_rate, seed=i)
+        start = time.perf_counter_ns()
+        try:
+            pa3_client.run(options, sensor, log, say=lambda *values: None)
+        finally:
+            sensor.cleanup()
+        if i >= args.warmup:
+            record(time.perf_counter_ns() - start)
+
+WORKERS = {'pa1': pa1_worker, 'pa2': pa2_worker, 'pa3': pa3_worker}
+
+# server command lines for --spawn
+def server_command(args, logdir):
+    if args.protocol == 'pa1':
+        return [sys.executable, os.path.join(ROOT, 'PA1', 'server.py'), '--host', args.host,
+                '--port', str(args.port), '--mode', args.server_mode, '-q']
+    if args.protocol == 'pa2':
+        return [sys.executable, os.path.join(ROOT, 'PA2', 'lightserver.py'), '-p', str(args.port),
+                '-l', os.path.join(logdir, 'server_log.txt')]
+    return [sys.executable, os.path.join(ROOT, 'PA3', 'lightserver.py'), '-p', str(args.port),
+            '-l', os.path.join(logdir, 'server_log.txt'), '--gpio', gpio.SIMULATED]
+
+def free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def wait_for_server(args, process, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with status {process.returncode}')
+        if args.protocol == 'pa3':
+            # nothing to connect to over UDP, the client retransmits its SYN anyway
+            time.sleep(0.5)
+            return
+        try:
+            socket.create_connection((args.host, args.port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Server did not start listening on port {args.port}')
+
+# CPU seconds a process has used so far (Linux), None if it cannot be read
+def process_cpu(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+# nearest-rank percentile of sorted values
+def percentile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def run(args, server_pid=None):
+    per_worker = [args.messages // args.concurrency + (i < args.messages % args.concurrency) for i in range(args.concurrency)]
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    worker = WORKERS[args.protocol]
+
+    def record(ns):
+        with lock:
+            latencies.append(ns)
+
+    def work(count):
+        try:
+            worker(args, count, record)
+        except Exception as e:
+            with lock:
+                errors.append(f'{type(e).__name__}: {e}')
+
+    threads = [threading.Thread(target=work, args=(count,), daemon=True) for count in per_worker if count]
+    server_cpu = process_cpu(server_pid) if server_pid else None
+    client_cpu = time.process_time()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    client_cpu = time.process_time() - client_cpu
+    if server_cpu is not None:
+        end = process_cpu(server_pid)
+        server_cpu = None if end is None else end - server_cpu
+
+    latencies.sort()
+    completed = len(latencies)
+    result = {
+        'protocol': args.protocol,
+        'concurrency': args.concurrency,
+        'messages': args.messages,
+        'completed': completed,
+        'errors': len(errors),
+        'duration_s': round(elapsed, 6),
+        'throughput_msg_s': round(completed / elapsed, 1) if elapsed else None,
+        'latency_us': None,
+        'cpu_us_per_msg': {
+            'client': round(client_cpu / completed * 1e6, 2) if completed else None,
+            'server': round(server_cpu / completed * 1e6, 2) if completed and server_cpu is not None else None,
+        },
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+    if latencies:
+        result['latency_us'] = {
+            'min': round(latencies[0] / 1e3, 1),
+            'mean': round(sum(latencies) / completed / 1e3, 1),
+            'p50': round(percentile(latencies, 0.50) / 1e3, 1),
+            'p99': round(percentile(latencies, 0.99) / 1e3, 1),
+            'p999': round(percentile(latencies, 0.999) / 1e3, 1),
+            'max': round(latencies[-1] / 1e3, 1),
+        }
+    if errors:
+        result['first_errors'] = errors[:5]
+    if args.protocol == 'pa1':
+        result['server_mode'] = args.server_mode if args.spawn else None
+    if args.protocol == 'pa3':
+        result['motion_events'] = args.motion_events
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the PA1, PA2 and PA3 servers.")
+    parser.add_argument('protocol', choices=PROTOCOLS, help='Protocol to drive')
+    parser.add_argument('--host', type=str, default='localhost', help='Server host')
+    parser.add_argument('-p', '--port', type=int, help='Server port (default 12345, or a free port with --spawn)')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Concurrent connections/sessions (one thread each)')
+    parser.add_argument('-n', '--messages', type=int, default=10000, help='Messages (pa3: sessions) in total')
+    parser.add_argument('--warmup', type=int, default=0, help='Untimed messages per worker before measuring')
+    parser.add_argument('--spawn', action='store_true', help='Start the server for this run on loopback and stop it afterwards')
+    parser.add_argument('--server-pid', type=int, help='Measure the CPU time of an already running server')
+    parser.add_argument('--server-mode', choices=('blocking', 'asyncio'), default='asyncio', help='pa1 with --spawn: server engine')
+    parser.add_argument('--service-type', type=int, default=1, help='pa1: service type of the payload')
+    parser.add_argument('--payload', type=str, default='42', help='pa1: payload value')
+    parser.add_argument('--legacy', action='store_true', help='pa3: two datagram framing')
+    parser.add_argument('--window', type=int, default=4, help='pa3: client sliding window')
+    parser.add_argument('--motion-events', type=int, default=1, help='pa3: motion updates per session')
+    parser.add_argument('--pir-rate', type=float, default=1000.0, help='pa3: simulated PIR edges per second')
+    parser.add_argument('--client-log', type=str, help='pa3: client packet log (default: in a temporary directory)')
+    parser.add_argument('-o', '--output', type=str, help='Also write the JSON result to this file')
+    args = parser.parse_args()
+    if args.concurrency < 1 or args.messages < 1:
+        parser.error('--concurrency and --messages must be positive')
+
+    logdir = tempfile.mkdtemp(prefix='loadgen-')
+    if args.client_log is None:
+        args.client_log = os.path.join(logdir, 'client_log.txt')
+
+    server = None
+    server_pid = args.server_pid
+    if args.spawn:
+        if args.port is None:
+            args.port = free_port(socket.SOCK_DGRAM if args.protocol == 'pa3' else socket.SOCK_STREAM)
+        server = subprocess.Popen(server_command(args, logdir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_pid = server.pid
+    elif args.port is None:
+        args.port = 12345
+
+    try:
+        if server is not None:
+            wait_for_server(args, server)
+        result = run(args, server_pid)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = json.dumps(result, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report + '\n')
+    exit(1 if result['errors'] else 0)
@@ -0,0 +1,180 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# make the shared modules importable when run as a script
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from common import framing
+from PA1 import client as pa1_client
+from PA1 import codec as pa1_codec
+from PA1 import server as pa1_server
+from PA2 import lightclient as pa2_client
+from PA2 import lightserver as pa2_server
+from PA3 import lightclient as pa3_client
+from PA3 import lightserver as pa3_server
+
+# Micro-benchmarks for the per-message encode/decode functions. Each one reports ns/op (best
+# of --repeat timed runs, GC off) and the peak bytes tracemalloc sees allocated during one call.
+# Results are compared with a stored baseline; anything slower or allocating more than
+# --threshold over it is a regression and makes the run exit with status 1.
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'microbench_baseline.json')
+
+# a peer that sends one frame per recv(): every recv_into gets the same frame again
+class FakeSocket:
+    def __init__(self, frame):
+        self.frame = bytes(frame)
+
+    def recv_into(self, buffer, nbytes=0):
+        buffer[:len(self.frame)] = self.frame
+        return len(self.frame)
+
+# the PA3 modules log every packet through asynclog; only the packet code is measured here
+class NullLog:
+    binary = False
+
+    def log(self, message):
+        pass
+
+PA1_SAMPLES = {1: '42', 2: '3.14', 3: 'Hello, server', 4: '1234567890123', 5: '2.718281828459045', 6: 'deadbeefcafe'}
+
+# name -> zero-argument callable doing one operation
+def benchmarks():
+    cases = {}
+    for service_type, payload in PA1_SAMPLES.items():
+        cases[f'pa1.client.create_packet[{service_type}]'] = \
+            lambda service_type=service_type, payload=payload: pa1_client.create_packet(1, 4, service_type, payload)
+
+        frame = pa1_client.create_packet(1, 4, service_type, payload)
+        reader = framing.FrameReader(FakeSocket(frame), framing.BBBH)
+        cases[f'pa1.server.unpack_packet[{service_type}]'] = lambda reader=reader: pa1_server.unpack_packet(reader)
+
+        buffer = bytearray(len(frame))
+        value = pa1_codec.decode(service_type, frame[pa1_codec.HEADER.size:])
+        cases[f'pa1.codec.pack_into[{service_type}]'] = \
+            lambda buffer=buffer, service_type=service_type, value=value: pa1_codec.pack_into(buffer, 0, 1, 4, service_type, value)
+        cases[f'pa1.codec.unpack_from[{service_type}]'] = lambda frame=frame: pa1_codec.unpack_from(frame, 0)
+
+    for command in ('HELLO', 'LIGHTON'):
+        cases[f'pa2.create_packet[{command}]'] = lambda command=command: pa2_client.create_packet(17, 1, command)
+        reader = framing.FrameReader(FakeSocket(pa2_client.create_packet(17, 1, command)), framing.III)
+        cases[f'pa2.unpack_packet[{command}]'] = lambda reader=reader: pa2_server.unpack_packet(reader)
+
+    for side, module in (('client', pa3_client), ('server', pa3_server)):
+        log = NullLog()
+        cases[f'pa3.{side}.create_packet[motion]'] = \
+            lambda module=module, log=log: module.create_packet(log, sequence_number=1000, ack_number=2000, payload=':MotionDetected')
+        cases[f'pa3.{side}.create_packet[ack]'] = \
+            lambda module=module, log=log: module.create_packet(log, sequence_number=1000, ack_number=2000, ack=1)
+        header_data, payload_data = module.create_packet(log, sequence_number=1000, ack_number=2000, payload=':MotionDetected')
+        cases[f'pa3.{side}.unpack_packet'] = \
+            lambda module=module, log=log, header_data=header_data, payload_data=payload_data: module.unpack_packet(log, header_data, payload_data)
+        cases[f'pa3.{side}.create_packet[ack,varlen]'] = \
+            lambda module=module, log=log: module.create_packet(log, sequence_number=1000, ack_number=2000, ack=1, varlen=True)
+        header_data, payload_data = module.create_packet(log, sequence_number=1000, ack_number=2000, payload=':MotionDetected', varlen=True)
+        cases[f'pa3.{side}.unpack_packet[varlen]'] = \
+            lambda module=module, log=log, header_data=header_data, payload_data=payload_data: module.unpack_packet(log, header_data, payload_data)
+    return cases
+
+# best ns/op over repeat runs of enough calls to take about target seconds each
+def time_op(op, repeat, target):
+    loops = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            op()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= target * 1e9 / 10 or loops >= 1 << 24:
+            break
+        loops *= 2
+    loops = max(int(loops * target * 1e9 / max(elapsed, 1)), 1)
+
+    best = None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            for _ in range(loops):
+                op()
+            per_op = (time.perf_counter_ns() - start) / loops
+            best = per_op if best is None else min(best, per_op)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+# smallest peak of traced memory above the starting point during a single call
+def allocated_bytes(op, samples=5):
+    op() # first call may fill caches (struct formats, interned strings)
+    tracemalloc.start()
+    try:
+        result = None
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            op()
+            peak = tracemalloc.get_traced_memory()[1] - before
+            result = peak if result is None else min(result, peak)
+        return result
+    finally:
+        tracemalloc.stop()
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['ns_per_op'] > base['ns_per_op'] * (1 + threshold):
+            regressions.append(f"{name}: {result['ns_per_op']:.0f} ns/op, baseline {base['ns_per_op']:.0f}")
+        if result['alloc_bytes'] > base['alloc_bytes'] * (1 + threshold):
+            regressions.append(f"{name}: {result['alloc_bytes']} bytes/op, baseline {base['alloc_bytes']}")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the packet encode/decode functions.")
+    parser.add_argument('-k', '--filter', type=str, default='', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per benchmark (best one counts)')
+    parser.add_argument('--target', type=float, default=0.05, help='Seconds per timed run')
+    parser.add_argument('--baseline', type=str, default=BASELINE, help='Baseline file')
+    parser.add_argument('--save', action='store_true', help='Store these results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown/extra allocation over the baseline (0.25 = 25%%)')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    for name, op in benchmarks().items():
+        if args.filter in name:
+            results[name] = {'ns_per_op': round(time_op(op, args.repeat, args.target), 1), 'alloc_bytes': allocated_bytes(op)}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'benchmark':<40} {'ns/op':>10} {'baseline':>10} {'bytes/op':>9}")
+        for name, result in results.items():
+            base = baseline.get(name, {}).get('ns_per_op')
+            print(f"{name:<40} {result['ns_per_op']:>10.0f} {'' if base is None else f'{base:.0f}':>10} {result['alloc_bytes']:>9}")
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(sorted(baseline.items())), f, indent=2)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline}')
+        exit(0)
+
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print('REGRESSION', regression)
+    exit(1 if regressions else 0)
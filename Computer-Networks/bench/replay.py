@@ -0,0 +1,309 @@
+import argparse
+import base64
+import collections
+import json
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+# make the shared modules importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import framing
+
+# Capture and replay of real sessions.
+#   record: a proxy between clients and a server that writes every frame (TCP, cut with the
+#           protocol's FrameLayout) or datagram (UDP) with its time and session to a capture
+#   replay: opens one connection per recorded session, sends the client's frames at the
+#           recorded pacing (or --speed times faster, or --speed 0 as fast as possible) and
+#           checks that the server's answers byte-match the recorded ones
+#
+# Capture file: JSON lines. The first one describes the capture, then one per frame:
+#   {"t": seconds since the capture started, "session": n, "dir": "in"|"out", "data": base64}
+# "in" is client -> server, "out" server -> client.
+#
+# PA3 servers pick a random initial sequence number per session; run them with --isn both
+# when recording and when replaying so their packets can match.
+
+CAPTURE_VERSION = 1
+
+# TCP protocols and how their streams are cut into frames; pa3 is UDP, one frame per datagram
+LAYOUTS = {'pa1': framing.BBBH, 'pa2': framing.III}
+PROTOCOLS = ('pa1', 'pa2', 'pa3')
+
+class CaptureWriter:
+    def __init__(self, path, protocol):
+        self.file = open(path, 'w', buffering=1) # line buffered: a running or killed recorder leaves a usable capture
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.sessions = 0
+        self.frames = 0
+        self.file.write(json.dumps({'capture': CAPTURE_VERSION, 'protocol': protocol, 'started': time.time()}) + '\n')
+
+    def new_session(self):
+        with self.lock:
+            self.sessions += 1
+            return self.sessions
+
+    def frame(self, session, direction, data):
+        line = json.dumps({'t': round(time.monotonic() - self.started, 6), 'session': session, 'dir': direction,
+                           'data': base64.b64encode(data).decode('ascii')})
+        with self.lock:
+            self.file.write(line + '\n')
+            self.frames += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_capture(path):
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get('capture') != CAPTURE_VERSION:
+            raise ValueError(f'{path} is not a capture file')
+        sessions = collections.defaultdict(list)
+        for line in f:
+            frame = json.loads(line)
+            sessions[frame['session']].append((frame['t'], frame['dir'], base64.b64decode(frame['data'])))
+    return header, sessions
+
+# --- recording proxy
+
+def _pump(source, destination, layout, capture, session, direction):
+    reader = framing.FrameReader(source, layout)
+    try:
+        while True:
+            frame = reader.read_frame()
+            if frame is None:
+                break
+            header, payload = frame
+            data = layout.header.pack(*header) + bytes(payload)
+            capture.frame(session, direction, data)
+            destination.sendall(data)
+    except (OSError, ConnectionError):
+        pass
+    finally:
+        # pass the close on to the other side
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def record_tcp(args, capture):
+    layout = LAYOUTS[args.protocol]
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((args.listen_host, args.listen_port))
+        listener.listen()
+        while True:
+            client, _ = listener.accept()
+            try:
+                server = socket.create_connection((args.server, args.port))
+            except OSError as e:
+                print(f'Cannot reach the server: {e}')
+                client.close()
+                continue
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = capture.new_session()
+            threading.Thread(target=_pump, args=(client, server, layout, capture, session, 'in'), daemon=True).start()
+            threading.Thread(target=_pump, args=(server, client, layout, capture, session, 'out'), daemon=True).start()
+
+def record_udp(args, capture):
+    buffer = bytearray(65536)
+    selector = selectors.DefaultSelector()
+    upstreams = {} # client address -> (socket to the server, session)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as listener:
+        listener.bind((args.listen_host, args.listen_port))
+        selector.register(listener, selectors.EVENT_READ, None)
+        while True:
+            for key, _ in selector.select():
+                if key.data is None: # from a client
+                    nbytes, address = listener.recvfrom_into(buffer)
+                    if address not in upstreams:
+                        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        upstream.connect((args.server, args.port))
+                        upstreams[address] = (upstream, capture.new_session())
+                        selector.register(upstream, selectors.EVENT_READ, address)
+                    upstream, session = upstreams[address]
+                    capture.frame(session, 'in', bytes(buffer[:nbytes]))
+                    try:
+                        upstream.send(buffer[:nbytes])
+                    except OSError: # e.g. ECONNREFUSED from an earlier datagram, the server is not up
+                        continue
+                else: # from the server, for the client in key.data
+                    upstream, session = upstreams[key.data]
+                    try:
+                        nbytes = upstream.recv_into(buffer)
+                    except OSError:
+                        continue
+                    capture.frame(session, 'out', bytes(buffer[:nbytes]))
+                    listener.sendto(buffer[:nbytes], key.data)
+
+# --- replay
+
+class SessionResult:
+    def __init__(self):
+        self.sent = 0
+        self.expected = 0
+        self.matched = 0
+        self.mismatched = []
+        self.missing = 0
+        self.extra = 0
+        self.error = None
+
+def _wait_until(when, started, speed):
+    if speed:
+        delay = started + when / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+def _compare(result, expected, received, ordered):
+    result.expected = len(expected)
+    if ordered:
+        for index, (want, got) in enumerate(zip(expected, received)):
+            if want == got:
+                result.matched += 1
+            else:
+                result.mismatched.append((index, want, got))
+        result.missing = max(len(expected) - len(received), 0)
+        result.extra = max(len(received) - len(expected), 0)
+    else:
+        # datagrams: the order of replies (e.g. blink ACKs vs. a FIN ACK) depends on timing
+        remaining = collections.Counter(expected)
+        for got in received:
+            if remaining[got]:
+                remaining[got] -= 1
+                result.matched += 1
+            else:
+                result.extra += 1
+        result.missing = sum(remaining.values())
+
+def replay_session(args, frames, started, result):
+    expected = [data for _, direction, data in frames if direction == 'out']
+    received = []
+    try:
+        if args.protocol in LAYOUTS:
+            layout = LAYOUTS[args.protocol]
+            sock = socket.create_connection((args.server, args.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((args.server, args.port))
+        done = threading.Event()
+
+        # answers are read on their own thread so pacing the requests never blocks on them
+        def receive():
+            sock.settimeout(args.timeout)
+            try:
+                if args.protocol in LAYOUTS:
+                    reader = framing.FrameReader(sock, layout)
+                    while len(received) < len(expected):
+                        frame = reader.read_frame()
+                        if frame is None:
+                            break
+                        header, payload = frame
+                        received.append(layout.header.pack(*header) + bytes(payload))
+                else:
+                    while len(received) < len(expected):
+                        received.append(sock.recv(65536))
+            except (socket.timeout, OSError):
+                pass
+            done.set()
+
+        receiver = threading.Thread(target=receive, daemon=True)
+        receiver.start()
+        with sock:
+            for when, direction, data in frames:
+                if direction != 'in':
+                    continue
+                _wait_until(when, started, args.speed)
+                if args.protocol in LAYOUTS:
+                    sock.sendall(data)
+                else:
+                    sock.send(data)
+                result.sent += 1
+            done.wait()
+    except OSError as e:
+        result.error = str(e)
+    _compare(result, expected, received, ordered=args.protocol in LAYOUTS)
+
+def replay(args):
+    header, sessions = read_capture(args.capture)
+    if header['protocol'] != args.protocol:
+        raise ValueError(f"Capture is {header['protocol']}, not {args.protocol}")
+    results = {session: SessionResult() for session in sessions}
+    # all sessions share one clock, so their recorded overlap is reproduced; paced runs start
+    # a little ahead so every thread is waiting when the first frame is due
+    started = time.monotonic() + (0.1 if args.speed else 0)
+    threads = [threading.Thread(target=replay_session, args=(args, frames, started, results[session]), daemon=True)
+               for session, frames in sessions.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    totals = {
+        'protocol': args.protocol,
+        'sessions': len(sessions),
+        'speed': args.speed or 'max',
+        'sent': sum(result.sent for result in results.values()),
+        'expected': sum(result.expected for result in results.values()),
+        'matched': sum(result.matched for result in results.values()),
+        'mismatched': sum(len(result.mismatched) for result in results.values()),
+        'missing': sum(result.missing for result in results.values()),
+        'extra': sum(result.extra for result in results.values()),
+        'errors': sum(1 for result in results.values() if result.error),
+        'duration_s': round(elapsed, 3),
+    }
+    totals['frames_per_s'] = round((totals['sent'] + totals['matched']) / elapsed, 1) if elapsed > 0 else None
+    return totals, results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record sessions through a proxy and replay them against a server.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    record = commands.add_parser('record', help='Proxy clients to a server and capture every frame')
+    record.add_argument('protocol', choices=PROTOCOLS, help='Protocol spoken through the proxy')
+    record.add_argument('capture', help='Capture file to write')
+    record.add_argument('--listen-host', type=str, default='localhost', help='Proxy address for the clients')
+    record.add_argument('--listen-port', type=int, required=True, help='Proxy port for the clients')
+    record.add_argument('-s', '--server', type=str, default='localhost', help='Server host')
+    record.add_argument('-p', '--port', type=int, default=12345, help='Server port')
+    replay_command = commands.add_parser('replay', help='Replay a capture and compare the answers')
+    replay_command.add_argument('protocol', choices=PROTOCOLS, help='Protocol of the capture')
+    replay_command.add_argument('capture', help='Capture file to replay')
+    replay_command.add_argument('-s', '--server', type=str, default='localhost', help='Server host')
+    replay_command.add_argument('-p', '--port', type=int, default=12345, help='Server port')
+    replay_command.add_argument('--speed', type=float, default=1.0, help='Pacing: 1 = as recorded, N = N times faster, 0 = as fast as possible')
+    replay_command.add_argument('--timeout', type=float, default=5.0, help='Seconds to wait for an expected answer')
+    replay_command.add_argument('-v', '--verbose', action='store_true', help='Show the first mismatching frames')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        capture = CaptureWriter(args.capture, args.protocol)
+        print(f'Recording {args.protocol} on {args.listen_host}:{args.listen_port} -> {args.server}:{args.port}')
+        try:
+            (record_tcp if args.protocol in LAYOUTS else record_udp)(args, capture)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            capture.close()
+            print(f'\n{capture.frames} frames in {capture.sessions} sessions written to {args.capture}')
+    else:
+        totals, results = replay(args)
+        print(json.dumps(totals, indent=2))
+        if args.verbose:
+            shown = 0
+            for session, result in results.items():
+                for index, want, got in result.mismatched:
+                    if shown == 10:
+                        break
+                    print(f'session {session} frame {index}: expected {want.hex() if want else None}, got {got.hex() if got else None}')
+                    shown += 1
+                if result.error:
+                    print(f'session {session}: {result.error}')
+        exit(0 if totals['matched'] == totals['expected'] and not totals['extra'] and not totals['errors'] else 1)
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Startup-time benchmark for the CLI entry points. For each module it runs
+# `python -X importtime -c "import MODULE"` and reports the cumulative import time (best of
+# --repeat), the imports that cost the most on their own, and any module that is supposed to
+# be loaded only on demand (argparse, asyncio, ...) but got imported anyway. It also times a
+# whole `python SCRIPT --help` against a bare `python -c pass` and shows the difference
+# (+spawn), for reference: the interpreter itself is a floor no script can go below.
+# The budget applies to the import time, which does not include that floor. Any entry point
+# whose import takes over --budget milliseconds, or that loads a deferred module, makes the
+# run exit with status 1.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module -> script that is started for it
+ENTRY_POINTS = {
+    'PA1.client': 'PA1/client.py',
+    'PA1.server': 'PA1/server.py',
+    'PA1.bulk': 'PA1/bulk.py',
+    'PA2.lightclient': 'PA2/lightclient.py',
+    'PA2.lightserver': 'PA2/lightserver.py',
+    'PA2.lightpool': 'PA2/lightpool.py',
+    'PA3.lightclient': 'PA3/lightclient.py',
+    'PA3.lightserver': 'PA3/lightserver.py',
+    'PA3.fanout': 'PA3/fanout.py',
+    'common.binlog': 'common/binlog.py',
+}
+
+# imported only by the code paths that need them (CLI parsing, asyncio engine, metrics
+# endpoint, sendmmsg, log conversion, the Raspberry Pi GPIO, PA1 bulk encoding)
+DEFERRED = ('argparse', 'asyncio', 'http.server', 'ctypes', 're', 'datetime', 'RPi.GPIO', 'numpy')
+
+# milliseconds importing an entry point may take (-X importtime cumulative, so the
+# interpreter's own startup is not counted)
+BUDGET_MS = 50.0
+
+# -X importtime lines: "import time: self [us] | cumulative | imported package"
+def parse_importtime(stderr):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+def import_profile(module, repeat):
+    best = None
+    for _ in range(repeat):
+        run = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             cwd=ROOT, capture_output=True, text=True)
+        if run.returncode != 0:
+            raise RuntimeError(f'import {module} failed:\n{run.stderr}')
+        imports = parse_importtime(run.stderr)
+        total = next(cumulative for name, _, cumulative in imports if name == module)
+        if best is None or total < best[0]:
+            best = (total, imports)
+    return best
+
+def spawn_time(command, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def measure(module, script, repeat, top):
+    total_us, imports = import_profile(module, repeat)
+    loaded = {name for name, _, _ in imports}
+    heaviest = sorted(imports, key=lambda entry: entry[1], reverse=True)[:top]
+    return {
+        'import_ms': round(total_us / 1000, 1),
+        'spawn_ms': round(spawn_time([sys.executable, script, '--help'], repeat) * 1000, 1),
+        'heaviest': [[name, round(self_us / 1000, 1)] for name, self_us, _ in heaviest],
+        'deferred_loaded': [name for name in DEFERRED if name in loaded],
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Startup time of the CLI entry points.")
+    parser.add_argument('-k', '--filter', type=str, default='', help='Only measure modules whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement (best one counts)')
+    parser.add_argument('--top', type=int, default=3, help='Heaviest imports shown per module')
+    parser.add_argument('--budget', type=float, default=BUDGET_MS, help='Allowed import time in milliseconds')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    floor_ms = round(spawn_time([sys.executable, '-c', 'pass'], args.repeat) * 1000, 1)
+    results = {module: measure(module, script, args.repeat, args.top)
+               for module, script in ENTRY_POINTS.items() if args.filter in module}
+
+    if args.json:
+        print(json.dumps({'interpreter_ms': floor_ms, 'budget_ms': args.budget, 'modules': results}, indent=2))
+    else:
+        print(f'interpreter startup {floor_ms:.1f} ms, budget {args.budget:.0f} ms per import')
+        print(f"{'module':<18} {'import ms':>9} {'spawn ms':>9} {'+spawn':>7}  heaviest imports")
+        for module, result in results.items():
+            heaviest = ', '.join(f'{name} {ms:.1f}' for name, ms in result['heaviest'])
+            print(f"{module:<18} {result['import_ms']:>9.1f} {result['spawn_ms']:>9.1f} "
+                  f"{result['spawn_ms'] - floor_ms:>7.1f}  {heaviest}")
+
+    failures = []
+    for module, result in results.items():
+        if result['import_ms'] > args.budget:
+            failures.append(f"{module}: import takes {result['import_ms']:.1f} ms, budget {args.budget:.0f} ms")
+        if result['deferred_loaded']:
+            failures.append(f"{module}: imports {', '.join(result['deferred_loaded'])} at startup")
+    for failure in failures:
+        print('OVER BUDGET', failure)
+    exit(1 if failures else 0)
@@ -0,0 +1,100 @@
+import collections
+import threading
+import time
+
+# Admission control for the servers: token buckets that bound how fast one peer (and all
+# peers together) may send, and a cap on concurrent sessions. Over the limit, datagram
+# servers drop (RateLimiter.allow) and stream servers stop reading from the connection for
+# a while (RateLimiter.delay), which pushes back on the sender through TCP flow control.
+
+# peers whose buckets are remembered; the least recently seen one is forgotten first
+MAX_PEERS = 65536
+
+class TokenBucket:
+    # rate tokens per second, holding at most burst
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # take n tokens if there are that many
+    def take(self, n=1, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    # take n tokens, going into debt if needed; returns seconds until the debt is paid off
+    def charge(self, n=1, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        self.tokens -= n
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+# one bucket per peer plus one shared by everybody; a rate of None is no limit
+class RateLimiter:
+    def __init__(self, peer_rate=None, total_rate=None, burst=None, max_peers=MAX_PEERS):
+        self.peer_rate = peer_rate
+        self.burst = burst
+        self.max_peers = max_peers
+        self.total = TokenBucket(total_rate) if total_rate else None # burst of one second
+        self._peers = collections.OrderedDict() # peer -> TokenBucket, least recently seen first
+        self._lock = threading.Lock()
+
+    def _peer(self, peer):
+        bucket = self._peers.get(peer)
+        if bucket is None:
+            bucket = self._peers[peer] = TokenBucket(self.peer_rate, self.burst)
+            if len(self._peers) > self.max_peers:
+                self._peers.popitem(last=False)
+        else:
+            self._peers.move_to_end(peer)
+        return bucket
+
+    # drop policy: True if peer may send n more messages now
+    def allow(self, peer, n=1):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._peer(peer) if self.peer_rate else None
+            if bucket is not None:
+                bucket._refill(now)
+                if bucket.tokens < n:
+                    return False
+            if self.total is not None and not self.total.take(n, now):
+                return False
+            if bucket is not None:
+                bucket.tokens -= n
+            return True
+
+    # throttle policy: seconds to stop reading from peer after it sent n messages
+    def delay(self, peer, n=1):
+        now = time.monotonic()
+        with self._lock:
+            delay = self._peer(peer).charge(n, now) if self.peer_rate else 0.0
+            if self.total is not None:
+                delay = max(delay, self.total.charge(n, now))
+            return delay
+
+# at most limit sessions at a time (None for no limit)
+class SessionLimit:
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.active = 0
+        self._lock = threading.Lock()
+
+    # False if the session must be turned away
+    def open(self):
+        with self._lock:
+            if self.limit is not None and self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def close(self):
+        with self._lock:
+            self.active -= 1
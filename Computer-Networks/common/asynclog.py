@@ -0,0 +1,152 @@
+import atexit
+import queue
+import threading
+import time
+
+# Packet handlers only put records on a bounded queue. A background thread formats them,
+# writes them in batches to a file that stays open, and flushes every flush_interval seconds.
+
+TIMESTAMP_FORMAT = '%Y-%m-%d-%H-%M-%S'
+
+# what log() does when the queue is full
+DROP = 'drop'    # discard the record and count it, the caller never waits
+BLOCK = 'block'  # wait for the writer thread to make room (backpressure)
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_BATCH_SIZE = 512
+
+_STOP = object()
+
+class AsyncLogger:
+    binary = False # subclasses that format records to bytes (binlog.BinaryLogger)
+
+    def __init__(self, path, timestamps=True, queue_size=DEFAULT_QUEUE_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, batch_size=DEFAULT_BATCH_SIZE, policy=DROP):
+        if policy not in (DROP, BLOCK):
+            raise ValueError(f'Unknown queue policy: {policy}')
+        self.path = path
+        self.timestamps = timestamps
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.policy = policy
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._second = None
+        self._timestamp = ''
+        self._file = open(path, 'ab' if self.binary else 'a')
+        self._thread = threading.Thread(target=self._run, name=f'log writer ({path})', daemon=True)
+        self._thread.start()
+
+    # queue one record, message is written as is (include the trailing newline)
+    def log(self, message):
+        self._put((time.time() if self.timestamps else None, message))
+
+    def _put(self, record):
+        if self.policy == BLOCK:
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # file-like alias so the logger can replace an open log file
+    write = log
+
+    # wait until everything queued so far is on disk
+    def flush(self):
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    # strftime once per second instead of once per record
+    def _format(self, record):
+        timestamp, message = record
+        if timestamp is None:
+            return message
+        second = int(timestamp)
+        if second != self._second:
+            self._second = second
+            self._timestamp = time.strftime(TIMESTAMP_FORMAT, time.localtime(second))
+        return f'[{self._timestamp}] {message}'
+
+    def _write(self, data):
+        self._file.write(data)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._file.flush()
+                last_flush = time.monotonic()
+                continue
+
+            # pull whatever else is already waiting, up to one batch
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            waiters = []
+            stop = False
+            for record in batch:
+                if record is _STOP:
+                    stop = True
+                elif isinstance(record, threading.Event):
+                    waiters.append(record)
+                else:
+                    lines.append(self._format(record))
+            if self.dropped != self._reported_dropped:
+                lines.append(self._format((time.time() if self.timestamps else None,
+                                           f'[log queue full, {self.dropped - self._reported_dropped} records dropped]\n')))
+                self._reported_dropped = self.dropped
+            self._write(b''.join(lines) if self.binary else ''.join(lines))
+
+            now = time.monotonic()
+            if waiters or stop or now - last_flush >= self.flush_interval:
+                self._file.flush()
+                last_flush = now
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                self._file.close()
+                return
+
+# one logger per file, shared by every thread/session writing to it
+_loggers = {} # path -> (logger, logger_class, kwargs)
+_loggers_lock = threading.Lock()
+
+# the logger for path; asking for a file that is already open with another logger class or
+# other options is an error rather than silently handing back the first logger
+def get_logger(path, logger_class=AsyncLogger, **kwargs):
+    with _loggers_lock:
+        entry = _loggers.get(path)
+        if entry is None:
+            logger = logger_class(path, **kwargs)
+            _loggers[path] = (logger, logger_class, kwargs)
+            return logger
+        logger, existing_class, existing_kwargs = entry
+        if existing_class is not logger_class or existing_kwargs != kwargs:
+            raise ValueError(f'{path} is already logged by {existing_class.__name__}({existing_kwargs}), '
+                             f'not {logger_class.__name__}({kwargs})')
+        return logger
+
+@atexit.register
+def close_all():
+    with _loggers_lock:
+        loggers = [logger for logger, _, _ in _loggers.values()]
+        _loggers.clear()
+    for logger in loggers:
+        logger.close()
@@ -0,0 +1,352 @@
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import OrderedDict, namedtuple
+
+# make the shared modules importable when run as a script
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import asynclog
+
+# Compact binary packet log. PATH holds fixed size records, PATH.strings holds every text they
+# refer to (peers, payloads, free-form lines), each string stored once. Both files are append
+# only; record timestamps never go backwards, so a time range is found by binary search.
+#
+# record (little endian, 32 bytes):
+#   timestamp_ns q, direction B, flags B, version H, type H, reserved H,
+#   seq I, ack I, peer I, text I      (peer/text: offset into PATH.strings, NO_STRING if none)
+# string: length H + utf-8 bytes
+
+RECORD = struct.Struct('<qBBHHHIIII')
+FILE_MAGIC = b'PKTLOG\x00\x01'
+STRINGS_MAGIC = b'PKTSTR\x00\x01'
+FILE_HEADER = struct.Struct('<8sI4x') # magic, record size
+STRING_LENGTH = struct.Struct('<H')
+NO_STRING = 0xFFFFFFFF
+STRINGS_SUFFIX = '.strings'
+
+# direction
+SEND = 0
+RECV = 1
+EVENT = 2 # free-form line, text only
+DIRECTIONS = {'send': SEND, 'recv': RECV, 'event': EVENT}
+
+# PA3 header flag bits
+FIN = 0b001
+SYN = 0b010
+ACK = 0b100
+FLAGS = {'ack': ACK, 'syn': SYN, 'fin': FIN}
+
+Record = namedtuple('Record', 'timestamp direction flags version type seq ack peer text')
+
+# string table cache: beyond this many interned strings the least recently used one is
+# forgotten, and stored again if it comes back. A string can therefore appear more than once
+# in the table, which is why readers look up every offset of a text (string_offsets).
+MAX_INTERNED = 65536
+
+def _check_header(f, magic, path):
+    data = f.read(FILE_HEADER.size)
+    if len(data) < FILE_HEADER.size or data[:8] != magic:
+        raise ValueError(f'{path} is not a binary packet log')
+
+# timestamp of the last complete record in a log, 0 if it has none
+def _final_timestamp(path):
+    with open(path, 'rb') as f:
+        records = (f.seek(0, os.SEEK_END) - FILE_HEADER.size) // RECORD.size
+        if records <= 0:
+            return 0
+        f.seek(FILE_HEADER.size + (records - 1) * RECORD.size)
+        return RECORD.unpack(f.read(RECORD.size))[0]
+
+# AsyncLogger whose records are packed into the binary format on the writer thread.
+# log()/write() still take text lines and store them as EVENT records (or drop them with
+# events=False, when the packet records already say everything), so it can replace a text
+# logger; packet() adds the structured records.
+class BinaryLogger(asynclog.AsyncLogger):
+    binary = True
+
+    def __init__(self, path, events=True, **kwargs):
+        kwargs['timestamps'] = True
+        self.events = events
+        for name, magic in ((path, FILE_MAGIC), (path + STRINGS_SUFFIX, STRINGS_MAGIC)):
+            with open(name, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(FILE_HEADER.pack(magic, RECORD.size))
+        self._strings = open(path + STRINGS_SUFFIX, 'ab')
+        self._string_offset = self._strings.tell()
+        self._interned = OrderedDict() # text -> offset, least recently used first
+        # appending to an existing log continues from its last record, so it stays sorted
+        self._last_timestamp = _final_timestamp(path)
+        super().__init__(path, **kwargs)
+
+    def log(self, message):
+        if self.events:
+            super().log(message)
+
+    write = log
+
+    def packet(self, direction, seq=0, ack=0, flags=0, version=0, type=0, peer=None, text=None):
+        self._put((time.time(), (direction, flags, version, type, seq, ack, peer, text)))
+
+    def close(self):
+        super().close()
+        self._strings.close()
+
+    # runs on the writer thread, which owns the string table
+    def _intern(self, text):
+        if text is None:
+            return NO_STRING
+        if not isinstance(text, str):
+            text = '%s:%s' % tuple(text[:2]) # (host, port) address
+        offset = self._interned.get(text)
+        if offset is not None:
+            self._interned.move_to_end(text)
+        else:
+            data = text.encode('utf-8')[:0xFFFF]
+            if len(self._interned) >= MAX_INTERNED:
+                self._interned.popitem(last=False)
+            offset = self._interned[text] = self._string_offset
+            self._strings.write(STRING_LENGTH.pack(len(data)) + data)
+            self._string_offset += STRING_LENGTH.size + len(data)
+        return offset
+
+    def _format(self, record):
+        timestamp, message = record
+        # clamp so the file stays sorted even if records were queued slightly out of order
+        timestamp = self._last_timestamp = max(int(timestamp * 1e9), self._last_timestamp)
+        if isinstance(message, str):
+            return RECORD.pack(timestamp, EVENT, 0, 0, 0, 0, 0, 0, NO_STRING, self._intern(message.rstrip('\n')))
+        direction, flags, version, type, seq, ack, peer, text = message
+        return RECORD.pack(timestamp, direction, flags, version, type, 0, seq & 0xFFFFFFFF, ack & 0xFFFFFFFF,
+                           self._intern(peer), self._intern(text))
+
+    # strings go to disk before the records that point at them
+    def _write(self, data):
+        self._strings.flush()
+        self._file.write(data)
+
+def get_logger(path, **kwargs):
+    return asynclog.get_logger(path, logger_class=BinaryLogger, **kwargs)
+
+# memory-mapped reader. Records are decoded one at a time, only where a query looks.
+class BinaryLogReader:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._strings_file = open(path + STRINGS_SUFFIX, 'rb')
+        _check_header(self._file, FILE_MAGIC, path)
+        _check_header(self._strings_file, STRINGS_MAGIC, path + STRINGS_SUFFIX)
+        size = os.fstat(self._file.fileno()).st_size
+        # a record still being written at the end is ignored
+        self.count = (size - FILE_HEADER.size) // RECORD.size
+        self.records = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b''
+        self.strings = mmap.mmap(self._strings_file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.fstat(self._strings_file.fileno()).st_size > FILE_HEADER.size else b''
+        self._timestamps = _Timestamps(self)
+        self._string_index = None # hash of a string's bytes -> its offsets, built on first lookup
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        for mapped in (self.records, self.strings):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        self._file.close()
+        self._strings_file.close()
+
+    def raw(self, index):
+        return RECORD.unpack_from(self.records, FILE_HEADER.size + index * RECORD.size)
+
+    def string(self, offset):
+        if offset == NO_STRING:
+            return None
+        length, = STRING_LENGTH.unpack_from(self.strings, offset)
+        start = offset + STRING_LENGTH.size
+        return str(self.strings[start:start + length], 'utf-8', 'replace')
+
+    def record(self, index):
+        timestamp, direction, flags, version, type, _, seq, ack, peer, text = self.raw(index)
+        return Record(timestamp, direction, flags, version, type, seq, ack, self.string(peer), self.string(text))
+
+    # offsets of every copy of text in the string table (a string can be stored more than once,
+    # see MAX_INTERNED). The table is scanned once per reader to index it by hash.
+    def string_offsets(self, text):
+        if self._string_index is None:
+            self._string_index = self._index_strings()
+        wanted = text.encode('utf-8')
+        return {offset for offset in self._string_index.get(hash(wanted), ())
+                if self._string_bytes(offset) == wanted}
+
+    def _string_bytes(self, offset):
+        length, = STRING_LENGTH.unpack_from(self.strings, offset)
+        start = offset + STRING_LENGTH.size
+        return self.strings[start:start + length]
+
+    def _index_strings(self):
+        index = {}
+        offset = FILE_HEADER.size
+        while offset + STRING_LENGTH.size <= len(self.strings):
+            length, = STRING_LENGTH.unpack_from(self.strings, offset)
+            start = offset + STRING_LENGTH.size
+            index.setdefault(hash(self.strings[start:start + length]), []).append(offset)
+            offset = start + length
+        return index
+
+    # index of the first record at or after timestamp_ns
+    def find_time(self, timestamp_ns):
+        return bisect.bisect_left(self._timestamps, timestamp_ns)
+
+    # records matching every given filter; start/end in ns since the epoch (end exclusive),
+    # flags_mask/flags_value select records where flags & flags_mask == flags_value
+    def query(self, start=None, end=None, peer=None, direction=None, flags_mask=0, flags_value=0, type=None):
+        first = 0 if start is None else self.find_time(start)
+        last = self.count if end is None else self.find_time(end)
+        peers = None if peer is None else self.string_offsets(peer)
+        if peers is not None and not peers:
+            return
+        for index in range(first, last):
+            raw = self.raw(index)
+            if direction is not None and raw[1] != direction:
+                continue
+            if raw[2] & flags_mask != flags_value:
+                continue
+            if type is not None and raw[4] != type:
+                continue
+            if peers is not None and raw[8] not in peers:
+                continue
+            yield self.record(index)
+
+# sequence view of the record timestamps for bisect
+class _Timestamps:
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return self.reader.count
+
+    def __getitem__(self, index):
+        return struct.unpack_from('<q', self.reader.records, FILE_HEADER.size + index * RECORD.size)[0]
+
+# text logs -> binary. PA3 lines are '[timestamp] "SEND" <seq> <ack> [a] [s] [f]' or
+# '[timestamp] text'; PA2 lines have no timestamps, so they get the time of the conversion and
+# the peer of the last 'Received connection' line (interleaved sessions can blur this).
+# Converting into an existing log appends; lines older than its last record get that
+# record's time, the file has to stay sorted.
+PA3_LINE = r'^\[(\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})\] (.*)$'
+PA3_PACKET = r'^"(SEND|RECV)" <(\d+)> <(\d+)> \[(\d)\] \[(\d)\] \[(\d)\]$'
+PA2_CONNECTION = r'^Received connection from \(IP, PORT\): \((.*), (\d+)\)$'
+PA2_DATA = r'^Received Data: version: (\d+) message_type: (\d+) length: (\d+)$'
+
+def _write_record(out, timestamp, direction, flags=0, version=0, type=0, seq=0, ack=0, peer=None, text=None):
+    out._put((timestamp, (direction, flags, version, type, seq, ack, peer, text)))
+
+def convert(text_path, binary_path, policy=asynclog.BLOCK):
+    import re
+    pa3_line, pa3_packet, pa2_connection, pa2_data = (re.compile(pattern) for pattern in (PA3_LINE, PA3_PACKET, PA2_CONNECTION, PA2_DATA))
+    out = BinaryLogger(binary_path, policy=policy)
+    peer = None
+    converted = 0
+    now = time.time()
+    try:
+        with open(text_path, encoding='utf-8', errors='replace') as text:
+            for line in text:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                timestamp = now
+                match = pa3_line.match(line)
+                if match:
+                    timestamp = time.mktime(time.strptime(match.group(1), asynclog.TIMESTAMP_FORMAT))
+                    line = match.group(2)
+                packet = pa3_packet.match(line)
+                connection = pa2_connection.match(line)
+                data = pa2_data.match(line)
+                if packet:
+                    direction, seq, ack, a, s, f = packet.groups()
+                    flags = (int(a) and ACK) | (int(s) and SYN) | (int(f) and FIN)
+                    _write_record(out, timestamp, SEND if direction == 'SEND' else RECV, flags, seq=int(seq), ack=int(ack))
+                elif data:
+                    version, type, length = data.groups()
+                    _write_record(out, timestamp, RECV, version=int(version), type=int(type), peer=peer)
+                else:
+                    if connection:
+                        peer = f'{connection.group(1)}:{connection.group(2)}'
+                    _write_record(out, timestamp, EVENT, peer=peer, text=line)
+                converted += 1
+    finally:
+        out.close()
+    return converted
+
+def parse_time(value):
+    try:
+        return int(float(value) * 1e9)
+    except ValueError:
+        return int(time.mktime(time.strptime(value, '%Y-%m-%dT%H:%M:%S')) * 1e9)
+
+def parse_flags(value):
+    # 'ack,syn' = ACK and SYN set; '!fin' = FIN clear
+    mask = wanted = 0
+    for name in value.split(','):
+        clear = name.startswith('!')
+        bit = FLAGS[name.lstrip('!').lower()]
+        mask |= bit
+        if not clear:
+            wanted |= bit
+    return mask, wanted
+
+def format_record(record):
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.timestamp // 10**9))
+    stamp += f'.{record.timestamp % 10**9 // 1000:06d}'
+    direction = ('SEND', 'RECV', 'EVENT')[record.direction] if record.direction <= EVENT else str(record.direction)
+    flags = '|'.join(name.upper() for name, bit in FLAGS.items() if record.flags & bit) or '-'
+    peer = record.peer or '-'
+    if record.direction == EVENT:
+        return f'{stamp} {direction:<5} {peer} {record.text}'
+    fields = f'seq={record.seq} ack={record.ack} flags={flags} version={record.version} type={record.type}'
+    return f'{stamp} {direction:<5} {peer} {fields}' + (f' {record.text!r}' if record.text else '')
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query and convert binary packet logs.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help='Print matching records')
+    query.add_argument('log', help='Binary log file')
+    query.add_argument('--since', type=parse_time, help='Start time (epoch seconds or YYYY-mm-ddTHH:MM:SS)')
+    query.add_argument('--until', type=parse_time, help='End time, exclusive')
+    query.add_argument('--peer', type=str, help='Only records of this peer (host:port)')
+    query.add_argument('--direction', choices=DIRECTIONS, help='Only sent, received or event records')
+    query.add_argument('--flags', type=parse_flags, help="Flag combination, e.g. 'syn,ack' or 'ack,!fin'")
+    query.add_argument('--type', type=int, help='Only this message type')
+    query.add_argument('--count', action='store_true', help='Print the number of matching records only')
+    convert_command = commands.add_parser('convert', help='Convert a PA2/PA3 text log')
+    convert_command.add_argument('text_log', help='Text log to read')
+    convert_command.add_argument('log', help='Binary log to append to')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        print(f'{convert(args.text_log, args.log)} lines converted')
+    else:
+        flags_mask, flags_value = args.flags or (0, 0)
+        with BinaryLogReader(args.log) as reader:
+            records = reader.query(args.since, args.until, args.peer,
+                                   None if args.direction is None else DIRECTIONS[args.direction],
+                                   flags_mask, flags_value, args.type)
+            if args.count:
+                print(sum(1 for _ in records))
+            else:
+                try:
+                    for record in records:
+                        print(format_record(record))
+                except BrokenPipeError:
+                    pass
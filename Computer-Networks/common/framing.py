@@ -0,0 +1,178 @@
+import struct
+
+# TCP is a byte stream: one recv() can return half a header, or several frames at once.
+# Frames are parsed in place out of a reusable bytearray filled with recv_into, and
+# header/payload slices are handed out as memoryviews instead of new bytes objects.
+# A returned memoryview is only valid until the next read on the same buffer.
+
+DEFAULT_BUFFER_SIZE = 65536
+# most kernels refuse sendmsg() with more than this many buffers
+IOV_MAX = 1024
+
+# a peer announced a payload longer than the connection allows; the stream cannot be resynced
+class FrameTooLarge(Exception):
+    pass
+
+# header layout: struct format plus the index of the payload length field in the header
+class FrameLayout:
+    def __init__(self, header_format, length_index):
+        self.header_format = header_format
+        self.header = struct.Struct(header_format)
+        self.header_size = self.header.size
+        self.length_index = length_index
+
+# PA1 -> Version (1 byte), Header Length (1 byte), Service Type (1 byte), Payload Length (2 bytes)
+BBBH = FrameLayout('BBBH', 3)
+# PA2 -> Version (4 bytes), Message type (4 bytes), Message Length (4 bytes)
+III = FrameLayout('III', 2)
+
+LAYOUTS = {layout.header_format: layout for layout in (BBBH, III)}
+
+def get_layout(header_format):
+    try:
+        return LAYOUTS[header_format]
+    except KeyError:
+        raise ValueError(f'Unknown header format: {header_format}')
+
+# receive buffer that frames are parsed out of without copying. With max_payload set, a
+# header announcing more is rejected before any of its payload is read, which also bounds
+# how far the buffer can grow.
+class FrameBuffer:
+    def __init__(self, layout, size=DEFAULT_BUFFER_SIZE, max_payload=None):
+        self.layout = layout
+        self.max_payload = max_payload
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    # writable free space at the end of the buffer (at least min_size bytes), for recv_into
+    def get_buffer(self, min_size=1):
+        if len(self._buf) - self._end < min_size:
+            self._make_room(min_size)
+        return self._view[self._end:]
+
+    # mark nbytes written into the view returned by get_buffer
+    def commit(self, nbytes):
+        self._end += nbytes
+
+    # copy already received bytes in (asyncio data_received, replayed captures)
+    def feed(self, data):
+        size = len(data)
+        self.get_buffer(size)[:size] = data
+        self._end += size
+
+    def _make_room(self, min_size):
+        pending = self._end - self._start
+        if len(self._buf) - pending >= min_size:
+            # move the unread tail to the front (memoryview assignment is a memmove)
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            # frame does not fit: switch to a bigger buffer; views handed out earlier keep the old one alive
+            buf = bytearray(max(len(self._buf) * 2, pending + min_size))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start = 0
+        self._end = pending
+
+    def _consume(self, start, nbytes):
+        self._start = start + nbytes
+        if self._start == self._end:
+            # buffer drained: rewind so the next read never needs a compaction
+            self._start = self._end = 0
+        return self._view[start:start + nbytes]
+
+    # exactly n bytes, or None if fewer than n are buffered
+    def take(self, n):
+        if self._end - self._start < n:
+            return None
+        return self._consume(self._start, n)
+
+    # bytes still missing before the next frame is complete
+    def needed(self):
+        pending = self._end - self._start
+        header_size = self.layout.header_size
+        if pending < header_size:
+            return header_size - pending
+        length = self.layout.header.unpack_from(self._buf, self._start)[self.layout.length_index]
+        if self.max_payload is not None and length > self.max_payload:
+            raise FrameTooLarge(f'Payload of {length} bytes announced, at most {self.max_payload} allowed')
+        return max(header_size + length - pending, 0)
+
+    # next complete frame as (header tuple, payload memoryview), or None if it has not fully arrived
+    def next_frame(self):
+        pending = self._end - self._start
+        header_size = self.layout.header_size
+        if pending < header_size:
+            return None
+        header = self.layout.header.unpack_from(self._buf, self._start)
+        length = header[self.layout.length_index]
+        if self.max_payload is not None and length > self.max_payload:
+            raise FrameTooLarge(f'Payload of {length} bytes announced, at most {self.max_payload} allowed')
+        if pending < header_size + length:
+            return None
+        start = self._start
+        return header, self._consume(start + header_size, length)
+
+    # every complete frame currently buffered
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+# FrameBuffer bound to a blocking socket
+class FrameReader:
+    def __init__(self, sock, layout, size=DEFAULT_BUFFER_SIZE, max_payload=None):
+        self.sock = sock
+        self.buffer = FrameBuffer(layout, size, max_payload)
+
+    # one recv_into straight into the buffer, returns False on EOF
+    def fill(self, min_size=1):
+        nbytes = self.sock.recv_into(self.buffer.get_buffer(min_size))
+        if nbytes == 0:
+            return False
+        self.buffer.commit(nbytes)
+        return True
+
+    # exactly n bytes, None on a clean EOF
+    def read_exact(self, n):
+        while len(self.buffer) < n:
+            if not self.fill(n - len(self.buffer)):
+                if len(self.buffer):
+                    raise ConnectionError('Connection closed in the middle of a read')
+                return None
+        return self.buffer.take(n)
+
+    # next frame as (header tuple, payload memoryview), None on a clean EOF
+    def read_frame(self):
+        while True:
+            frame = self.buffer.next_frame()
+            if frame is not None:
+                return frame
+            if not self.fill(self.buffer.needed()):
+                if len(self.buffer):
+                    raise ConnectionError('Connection closed in the middle of a frame')
+                return None
+
+    # frames that arrived together with the last read, without calling recv again
+    def buffered_frames(self):
+        return self.buffer.frames()
+
+# write many frames with vectored sendmsg() calls instead of one send() per frame
+def send_frames(sock, frames):
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(frames))
+        return
+    for i in range(0, len(frames), IOV_MAX):
+        batch = frames[i:i + IOV_MAX]
+        sent = sock.sendmsg(batch)
+        total = sum(len(frame) for frame in batch)
+        if sent < total:
+            # short write: push the rest of the batch out in one go
+            sock.sendall(b''.join(batch)[sent:])
@@ -0,0 +1,207 @@
+import bisect
+import threading
+import weakref
+
+# In-process counters and histograms for the servers, exposed in the Prometheus text format
+# on a loopback HTTP port. Every thread updates its own cell (a plain list found through a
+# threading.local), so the hot path takes no lock; a scrape sums the cells of all threads.
+
+# histogram buckets in seconds, 10us to 1s
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# threading.local drops a thread's values when the thread exits; a finalizer on this token
+# (stored next to the cell) moves the cell's numbers into the retired totals at that point
+class _ThreadToken:
+    pass
+
+# one list of numbers per thread, summed when read
+class _Cells:
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._cells = {} # id(cell) -> cell, for running threads
+        self._retired = [0] * size # totals of threads that have exited
+        self._lock = threading.Lock()
+
+    def cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0] * self.size
+            token = self._local.token = _ThreadToken()
+            with self._lock:
+                self._cells[id(cell)] = cell
+            weakref.finalize(token, self._retire, cell)
+            return cell
+
+    # the thread owning cell has exited, so the cell is not written any more: fold it in once
+    def _retire(self, cell):
+        with self._lock:
+            del self._cells[id(cell)]
+            self._retired = [a + b for a, b in zip(self._retired, cell)]
+
+    def total(self):
+        with self._lock:
+            totals = list(self._retired)
+            for cell in self._cells.values():
+                totals = [a + b for a, b in zip(totals, cell)]
+        return totals
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    # the metric for one combination of label values
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} takes labels {self.labelnames}, got {values}')
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _series(self):
+        if self.labelnames:
+            return [(dict(zip(self.labelnames, values)), child) for values, child in sorted(self._children.items())]
+        return [({}, self)]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for labels, series in self._series():
+            lines += series._samples(self.name, labels)
+        return lines
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._cells = _Cells(1)
+        self._local = self._cells._local
+
+    def _child(self):
+        return Counter(self.name, self.help)
+
+    def inc(self, amount=1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError: # first update from this thread
+            self._cells.cell()[0] += amount
+
+    def value(self):
+        return self._cells.total()[0]
+
+    def _samples(self, name, labels):
+        return [f'{name}_total{_format_labels(labels)} {_format_value(self.value())}']
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # one slot per bucket, one for +Inf, then the sum of all observations
+        self._cells = _Cells(len(self.buckets) + 2)
+        self._local = self._cells._local
+
+    def _child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value):
+        try:
+            cell = self._local.cell
+        except AttributeError: # first update from this thread
+            cell = self._cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def _samples(self, name, labels):
+        totals = self._cells.total()
+        lines = []
+        count = 0
+        for bound, n in zip(self.buckets + ('+Inf',), totals):
+            count += n
+            lines.append(f'{name}_bucket{_format_labels({**labels, "le": bound})} {count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(float(totals[-1]))}')
+        lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return lines
+
+# value read at scrape time, e.g. the size of a connection table
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, function):
+        super().__init__(name, help)
+        self.function = function
+
+    def _samples(self, name, labels):
+        return [f'{name}{_format_labels(labels)} {_format_value(self.function())}']
+
+# every metric of the process, by name
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+def counter(name, help, labelnames=()):
+    return _register(Counter(name, help, labelnames))
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labelnames, buckets))
+
+def gauge(name, help, function):
+    with _registry_lock:
+        metric = _registry[name] = Gauge(name, help, function) # the latest function wins
+    return metric
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+# serve /metrics on host:port from a background thread; returns the HTTP server.
+# http.server (and the email/ssl modules behind it) is only imported when a port is given.
+def serve(port, host='127.0.0.1'):
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name=f'metrics endpoint ({host}:{port})', daemon=True)
+    thread.start()
+    return server
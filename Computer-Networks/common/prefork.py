@@ -0,0 +1,163 @@
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+# Pre-fork worker mode for the TCP servers. The supervisor forks N workers; each one binds the
+# same port with SO_REUSEPORT, so the kernel spreads new connections across them, and runs the
+# normal serve loop. Workers that die are restarted (with a growing delay if they keep dying
+# right after starting). SIGTERM or SIGINT stops the supervisor: every worker gets SIGTERM,
+# has grace seconds to finish, and is killed after that.
+
+GRACE_PERIOD = 10
+# a worker that exits sooner than this after being started counts as crash looping
+MIN_UPTIME = 1.0
+MAX_RESTART_DELAY = 30.0
+# prctl(2) option: signal the process gets when its parent dies (Linux)
+PR_SET_PDEATHSIG = 1
+# where prctl is missing, seconds between checks that the supervisor is still there
+PARENT_CHECK_INTERVAL = 1.0
+
+# raised in the main thread of a worker (and of the supervisor) when it is asked to stop.
+# Derives from BaseException so that `except Exception` in a serve loop does not swallow it.
+class Shutdown(BaseException):
+    pass
+
+def _raise_shutdown(signum, frame):
+    raise Shutdown(signal.Signals(signum).name)
+
+# a worker must not outlive its supervisor (e.g. one killed with SIGKILL), or it would keep
+# serving on the shared port as an orphan: it gets SIGTERM, and shuts down as if stopped
+def _exit_with_parent(parent):
+    try:
+        import ctypes
+        if ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGTERM, 0, 0, 0) != 0:
+            raise OSError(ctypes.get_errno(), 'prctl failed')
+    except (ImportError, OSError, AttributeError):
+        def watch():
+            while os.getppid() == parent:
+                time.sleep(PARENT_CHECK_INTERVAL)
+            os.kill(os.getpid(), signal.SIGTERM)
+        threading.Thread(target=watch, name='supervisor watch', daemon=True).start()
+        return
+    # the supervisor may have died before prctl took effect
+    if os.getppid() != parent:
+        os.kill(os.getpid(), signal.SIGTERM)
+
+# listening TCP socket; reuse_port lets every worker bind its own socket to the same port
+def listen_socket(host, port, backlog=socket.SOMAXCONN, reuse_port=False):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((host, port))
+        s.listen(backlog)
+    except:
+        s.close()
+        raise
+    return s
+
+class Supervisor:
+    # serve_worker(index) runs the serve loop of worker index in the child process
+    def __init__(self, serve_worker, workers, grace=GRACE_PERIOD, name='worker'):
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+            raise RuntimeError('Worker mode needs fork() and SO_REUSEPORT')
+        self.serve_worker = serve_worker
+        self.workers = workers
+        self.grace = grace
+        self.name = name
+        self.pids = {} # pid -> worker index
+        self.started = {} # worker index -> start time
+        self.delays = {} # worker index -> restart delay while it keeps crashing
+        self.restarts = 0
+
+    def spawn(self, index):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        parent = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            self._worker(index, parent) # never returns
+        self.pids[pid] = index
+        self.started[index] = time.monotonic()
+        return pid
+
+    def _worker(self, index, parent):
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, _raise_shutdown)
+            signal.signal(signal.SIGINT, _raise_shutdown)
+            _exit_with_parent(parent)
+            self.serve_worker(index)
+        except Shutdown:
+            pass
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, _raise_shutdown)
+        signal.signal(signal.SIGINT, _raise_shutdown)
+        try:
+            for index in range(self.workers):
+                self.spawn(index)
+            print(f'Supervisor {os.getpid()} started {self.workers} {self.name} processes')
+            while True:
+                pid, status = os.wait()
+                index = self.pids.pop(pid, None)
+                if index is None:
+                    continue
+                print(f'{self.name} {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting')
+                # back off a worker that dies right after starting instead of forking in a tight loop
+                if time.monotonic() - self.started[index] < MIN_UPTIME:
+                    self.delays[index] = min(self.delays.get(index, 0.5) * 2, MAX_RESTART_DELAY)
+                    time.sleep(self.delays[index])
+                else:
+                    self.delays.pop(index, None)
+                self.restarts += 1
+                self.spawn(index)
+        except Shutdown:
+            pass
+        finally:
+            self.stop()
+
+    # SIGTERM every worker, SIGKILL whatever is still running after the grace period
+    def stop(self):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.grace
+        while self.pids and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.05)
+            else:
+                self.pids.pop(pid, None)
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.pids.clear()
+        print('Supervisor stopped')
+
+def run(serve_worker, workers, grace=GRACE_PERIOD, name='worker'):
+    Supervisor(serve_worker, workers, grace, name).run()